@@ -0,0 +1,375 @@
+import zmq
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import struct
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import pyzmq
+
+# Banco de carga: levanta Servidor + ChatBroadcast en un proceso aparte y lo ataca
+# con N clientes DEALER y M receptores SUB repartidos en varios procesos.
+# Imprime (o guarda) un JSON con rendimiento, latencias y memoria del servidor.
+# Con --transporte inproc todo corre en un solo proceso y los procesos son threads.
+
+MEZCLA_POR_DEFECTO = "msg=50,users=10,suma=30,login=10"
+
+# Mismo interfaz que un contexto de multiprocessing, pero con threads (para inproc)
+HILOS = SimpleNamespace(Process=threading.Thread, Event=threading.Event,
+                        Queue=queue.Queue, Barrier=threading.Barrier)
+
+def parsear_mezcla(texto):
+    """'msg=50,suma=30' -> (['msg', 'suma'], [50, 30])"""
+    comandos, pesos = [], []
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        if nombre not in ("msg", "users", "suma", "login", "hora", "stats"):
+            raise ValueError(f"Comando desconocido en la mezcla: {nombre}")
+        comandos.append(nombre)
+        pesos.append(float(peso or 1))
+    return comandos, pesos
+
+def percentiles(valores):
+    """p50/p99/p999/max en microsegundos de una lista de nanosegundos"""
+    if not valores:
+        return {"n": 0}
+    valores.sort()
+    n = len(valores)
+    def p(q):
+        return round(valores[min(n - 1, int(q * n))] / 1000, 1)
+    return {"n": n, "p50": p(0.50), "p99": p(0.99), "p999": p(0.999), "max": round(valores[-1] / 1000, 1)}
+
+def memoria_kb(pid):
+    """RSS del proceso en KB (Linux, /proc)"""
+    with open(f"/proc/{pid}/status") as f:
+        for linea in f:
+            if linea.startswith("VmRSS:"):
+                return int(linea.split()[1])
+    return 0
+
+def endpoints(transporte):
+    """(servidor, chat) donde escucha el servidor según el transporte"""
+    if transporte == "ipc":
+        base = f"ipc://{tempfile.gettempdir()}/pyzmq-bench-{os.getpid()}"
+        return f"{base}-servidor", f"{base}-chat"
+    if transporte == "inproc":
+        return "inproc://bench-servidor", "inproc://bench-chat"
+    return pyzmq.SERVIDOR_PORT, pyzmq.CHAT_PORT
+
+def arrancar_servidor(modo, trabajadores, ventana, endpoint_servidor, endpoint_chat, trazas, fichero_trazas):
+    """Arranca Servidor (o ServidorFragmentado) y ChatBroadcast y devuelve sus threads"""
+    cola_chat = pyzmq.ColaChat()
+    if modo == "procesos":
+        servidor = pyzmq.ServidorFragmentado(cola_chat, trabajadores or pyzmq.NUM_FRAGMENTOS,
+                                             puerto=endpoint_servidor)
+    else:
+        servidor = pyzmq.Servidor(cola_chat, trabajadores, puerto=endpoint_servidor)
+        if trazas > 0:
+            servidor.trazador = pyzmq.Trazador(trazas, fichero_trazas)
+    chat_broadcast = pyzmq.ChatBroadcast(cola_chat, ventana=ventana, puerto=endpoint_chat)
+    servidor.start()
+    chat_broadcast.start()
+    # Los fragmentos tardan lo que tarde en arrancar un proceso
+    pyzmq.esperar_listos(servidor, chat_broadcast, timeout=30)
+    return [servidor, chat_broadcast]
+
+def guardar_trazas(hilos):
+    if hilos[0].trazador is not None:
+        hilos[0].trazador.guardar()
+
+def proceso_servidor(modo, trabajadores, ventana, listo, endpoint_servidor, endpoint_chat,
+                     trazas, fichero_trazas):
+    """Ejecuta el servidor a medir (su salida por pantalla se descarta)"""
+    # Se redirige el descriptor, no sys.stdout, para que lo hereden los fragmentos
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    if modo == "asyncio":
+        import asyncio
+        import pyzmq_async
+        asyncio.run(pyzmq_async.servidor_async(listo, endpoint_servidor, endpoint_chat))
+        return
+
+    # Salir con sys.exit al terminar: multiprocessing cierra entonces los fragmentos
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    hilos = arrancar_servidor(modo, trabajadores, ventana, endpoint_servidor, endpoint_chat,
+                              trazas, fichero_trazas)
+    listo.set()
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        guardar_trazas(hilos)
+
+def generar_comando(nombre, cliente, conectado):
+    if nombre == "msg":
+        # La marca de tiempo viaja en el texto para medir la entrega por el chat
+        return f"/msg carga t={time.monotonic_ns()}"
+    if nombre == "suma":
+        return f"/suma {random.randint(0, 1000)} {random.randint(0, 1000)}"
+    if nombre == "login":
+        return "/logout" if conectado else f"/login {cliente}"
+    return f"/{nombre}"
+
+def proceso_clientes(indice, num_clientes, duracion, mezcla, ventana, endpoint,
+                     preparados, inicio, resultados):
+    """Simula num_clientes DEALER con hasta `ventana` peticiones en vuelo cada uno"""
+    comandos, pesos = parsear_mezcla(mezcla)
+    context = pyzmq.contexto_para(endpoint)
+    poller = zmq.Poller()
+    clientes = {}
+    for k in range(num_clientes):
+        nombre = f"bench-{indice}-{k}"
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.IDENTITY, nombre.encode())
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        poller.register(socket, zmq.POLLIN)
+        clientes[socket] = {"nombre": nombre, "conectado": False, "en_vuelo": {}}
+    ids = iter(range(1, 1 << 62))
+    latencias = []
+    # Los DEALER encolan hasta conectar: no hace falta esperar más
+    preparados.wait()
+
+    def enviar(socket, estado, comando):
+        id_peticion = struct.pack("!Q", next(ids))
+        estado["en_vuelo"][id_peticion] = time.monotonic_ns()
+        socket.send_multipart([b"", id_peticion, comando.encode()])
+
+    inicio.wait()
+    for socket, estado in clientes.items():
+        enviar(socket, estado, f"/login {estado['nombre']}")
+        estado["conectado"] = True
+
+    fin = time.monotonic() + duracion
+    while time.monotonic() < fin:
+        for socket, estado in clientes.items():
+            while len(estado["en_vuelo"]) < ventana:
+                nombre = random.choices(comandos, pesos)[0]
+                enviar(socket, estado, generar_comando(nombre, estado["nombre"], estado["conectado"]))
+                if nombre == "login":
+                    estado["conectado"] = not estado["conectado"]
+
+        for socket, _ in poller.poll(100):
+            estado = clientes[socket]
+            while True:
+                try:
+                    frames = socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                enviado = estado["en_vuelo"].pop(frames[1], None) if len(frames) == 3 else None
+                if enviado is not None:
+                    latencias.append(time.monotonic_ns() - enviado)
+
+    # Peticiones que seguían en vuelo al acabar la carga
+    sin_respuesta = sum(len(estado["en_vuelo"]) for estado in clientes.values())
+    for socket in clientes:
+        socket.close()
+    pyzmq.terminar_contexto(context)
+    resultados.put(("clientes", latencias, sin_respuesta))
+
+def proceso_receptores(num_receptores, duracion, endpoint, endpoint_servidor, preparados, inicio, resultados):
+    """M suscriptores SUB que miden cuánto tarda en llegar cada /msg de la carga
+
+    Los anuncios trazados se informan al servidor (/traza) por un DEALER, sin
+    esperar la respuesta.
+    """
+    context = pyzmq.contexto_para(endpoint, endpoint_servidor)
+    informes = context.socket(zmq.DEALER)
+    informes.setsockopt(zmq.LINGER, 0)
+    informes.connect(endpoint_servidor)
+    prefijo_traza = pyzmq.PREFIJO_TRAZA.encode()
+    poller = zmq.Poller()
+    sockets = []
+    confirmaciones = {}
+    for indice in range(num_receptores):
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        socket.setsockopt_string(zmq.SUBSCRIBE, "CHAT:")
+        # El servidor publica este tema al ver la suscripción: desde ahí no se pierde nada
+        confirmacion = f"{pyzmq.PREFIJO_CONFIRMACION}bench-{os.getpid()}-{indice}".encode()
+        socket.setsockopt(zmq.SUBSCRIBE, confirmacion)
+        confirmaciones[socket] = confirmacion
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+    latencias = []
+    recibidos = 0
+
+    limite = time.monotonic() + 5
+    while confirmaciones and time.monotonic() < limite:
+        for socket, _ in poller.poll(100):
+            if socket.recv_multipart()[0] == confirmaciones.get(socket):
+                socket.setsockopt(zmq.UNSUBSCRIBE, confirmaciones.pop(socket))
+    preparados.wait()
+
+    inicio.wait()
+    # Se escucha un poco más que la carga para recoger los últimos mensajes
+    fin = time.monotonic() + duracion + 0.5
+    while time.monotonic() < fin:
+        for socket, _ in poller.poll(100):
+            while True:
+                try:
+                    frames = socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if frames[0].startswith(pyzmq.PREFIJO_CONFIRMACION.encode()):
+                    continue
+                if len(frames) > 2 and frames[-1].startswith(prefijo_traza):
+                    id_traza = frames.pop()[len(prefijo_traza):].decode()
+                    informes.send_multipart([b"", f"/traza {id_traza} {time.time_ns()}".encode()])
+                # Lote agrupado [tema, secuencia, textos] o mensaje suelto [tema + texto, ...]
+                mensajes = pyzmq.desempaquetar_lote(frames[2]) if len(frames) == 3 else [frames[0].decode()]
+                ahora = time.monotonic_ns()
+                recibidos += len(mensajes)
+                for mensaje in mensajes:
+                    _, marca, t = mensaje.rpartition(" t=")
+                    if marca:
+                        latencias.append(ahora - int(t))
+
+    for socket in sockets:
+        socket.close()
+    informes.close()
+    pyzmq.terminar_contexto(context)
+    resultados.put(("receptores", latencias, recibidos))
+
+def ejecutar(args):
+    endpoint_servidor, endpoint_chat = endpoints(args.transporte)
+    if args.transporte == "inproc":
+        # Un solo proceso y un solo contexto: servidor, clientes y receptores son threads
+        with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+            hilos = arrancar_servidor(args.modo, args.trabajadores, args.agrupar,
+                                      endpoint_servidor, endpoint_chat, args.trazas, args.fichero_trazas)
+            try:
+                return medir(args, HILOS, os.getpid(), endpoint_servidor, endpoint_chat)
+            finally:
+                for hilo in hilos:
+                    hilo.detener()
+                for hilo in hilos:
+                    hilo.join()
+                guardar_trazas(hilos)
+
+    mp = multiprocessing.get_context("spawn")
+    listo = mp.Event()
+    # En modo procesos el servidor tiene hijos, y un proceso daemon no puede tenerlos
+    servidor = mp.Process(target=proceso_servidor,
+                          args=(args.modo, args.trabajadores, args.agrupar, listo, endpoint_servidor, endpoint_chat,
+                                args.trazas, args.fichero_trazas),
+                          daemon=args.modo != "procesos")
+    servidor.start()
+    listo.wait(10)
+    try:
+        return medir(args, mp, servidor.pid, endpoint_servidor, endpoint_chat)
+    finally:
+        servidor.terminate()
+        servidor.join()
+        if args.transporte == "ipc":
+            for endpoint in (endpoint_servidor, endpoint_chat):
+                with contextlib.suppress(OSError):
+                    os.unlink(endpoint[len("ipc://"):])
+
+def medir(args, mp, pid_servidor, endpoint_servidor, endpoint_chat):
+    """Lanza clientes y receptores (procesos o threads de `mp`) contra el servidor ya listo"""
+    inicio = mp.Event()
+    resultados = mp.Queue()
+    endpoint_servidor = pyzmq.endpoint_conexion(endpoint_servidor)
+    endpoint_chat = pyzmq.endpoint_conexion(endpoint_chat)
+
+    por_proceso = max(1, args.clientes // args.procesos)
+    repartos = [por_proceso if indice < args.procesos - 1 else args.clientes - por_proceso * (args.procesos - 1)
+                for indice in range(args.procesos)]
+    repartos = [num for num in repartos if num > 0]
+    # Cada proceso espera en la barrera con sus sockets listos (los SUB, con la
+    # suscripción ya confirmada): la carga empieza sin esperas fijas
+    preparados = mp.Barrier(len(repartos) + bool(args.receptores) + 1)
+    procesos = [mp.Process(target=proceso_clientes, daemon=True,
+                           args=(indice, num, args.duracion, args.mezcla, args.ventana, endpoint_servidor,
+                                 preparados, inicio, resultados))
+                for indice, num in enumerate(repartos)]
+    if args.receptores:
+        procesos.append(mp.Process(target=proceso_receptores, daemon=True,
+                                   args=(args.receptores, args.duracion, endpoint_chat, endpoint_servidor,
+                                         preparados, inicio, resultados)))
+    for proceso in procesos:
+        proceso.start()
+
+    preparados.wait()
+    memoria_inicio = memoria_kb(pid_servidor)
+    inicio.set()
+    t0 = time.monotonic()
+
+    latencias_peticion, latencias_chat = [], []
+    sin_respuesta = recibidos = 0
+    for _ in procesos:
+        tipo, latencias, extra = resultados.get()
+        if tipo == "clientes":
+            latencias_peticion.extend(latencias)
+            sin_respuesta += extra
+        else:
+            latencias_chat.extend(latencias)
+            recibidos = extra
+    transcurrido = time.monotonic() - t0
+    memoria_fin = memoria_kb(pid_servidor)
+
+    for proceso in procesos:
+        proceso.join()
+
+    return {
+        "config": vars(args),
+        "peticiones": len(latencias_peticion),
+        "sin_respuesta": sin_respuesta,
+        "rendimiento_rps": round(len(latencias_peticion) / args.duracion, 1),
+        "duracion_real_s": round(transcurrido, 3),
+        "latencia_peticion_us": percentiles(latencias_peticion),
+        "latencia_chat_us": percentiles(latencias_chat),
+        "mensajes_chat_recibidos": recibidos,
+        # Con inproc es la del proceso entero (servidor, clientes y receptores)
+        "memoria_servidor_kb": {
+            "inicio": memoria_inicio,
+            "fin": memoria_fin,
+            "crecimiento": memoria_fin - memoria_inicio,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de carga del sistema multi-cliente")
+    parser.add_argument("--clientes", type=int, default=50, help="clientes DEALER simulados")
+    parser.add_argument("--receptores", type=int, default=10, help="suscriptores SUB del chat")
+    parser.add_argument("--procesos", type=int, default=2, help="procesos que reparten a los clientes")
+    parser.add_argument("--duracion", type=float, default=10.0, help="segundos de carga")
+    parser.add_argument("--ventana", type=int, default=1, help="peticiones en vuelo por cliente")
+    parser.add_argument("--mezcla", default=MEZCLA_POR_DEFECTO, help="pesos por comando, p. ej. msg=50,suma=50")
+    parser.add_argument("--modo", choices=("hilos", "asyncio", "procesos"), default="hilos", help="implementación del servidor")
+    parser.add_argument("--trabajadores", type=int, default=0, help="trabajadores del Servidor (modo hilos) o procesos (modo procesos)")
+    parser.add_argument("--agrupar", type=float, default=0.0,
+                        help="ventana de agrupado del chat en segundos (modo hilos, 0 = sin agrupar)")
+    parser.add_argument("--transporte", choices=("tcp", "ipc", "inproc"), default="tcp",
+                        help="tcp (loopback), ipc (socket Unix) o inproc (todo en un proceso)")
+    parser.add_argument("--trazas", type=float, default=0.0,
+                        help="fracción de anuncios del chat que se trazan (modo hilos, 0 = ninguno)")
+    parser.add_argument("--fichero-trazas", default=pyzmq.FICHERO_TRAZAS,
+                        help="fichero Chrome trace-event con las trazas del servidor")
+    parser.add_argument("--salida", help="fichero JSON para el resultado (por defecto, la pantalla)")
+    args = parser.parse_args()
+    parsear_mezcla(args.mezcla)
+    if args.transporte == "inproc" and args.modo == "asyncio":
+        parser.error("--transporte inproc no admite --modo asyncio (usa su propio contexto)")
+    if args.trazas > 0 and args.modo != "hilos":
+        parser.error("--trazas solo está disponible con --modo hilos")
+
+    resultado = json.dumps(ejecutar(args), indent=2)
+    if args.salida:
+        with open(args.salida, "w") as f:
+            f.write(resultado + "\n")
+    else:
+        print(resultado)
+
+if __name__ == "__main__":
+    main()
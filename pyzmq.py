@@ -1,210 +1,3200 @@
 import zmq
 import threading
 import time
-from queue import Queue
+import argparse
+from queue import Queue, Empty
+from collections import deque, OrderedDict
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor
+from array import array
+import bisect
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import re
+import struct
 import sys
 import random
+import hashlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Opcional: sin NumPy la suma de vectores se hace en Python
 
 # Puertos de comunicación
 SERVIDOR_PORT = "5555"
 CHAT_PORT = "5556"
 HEARTBEAT_PORT = "5557"
+METRICAS_PORT = "5558"
+# Federación de nodos: el broker recibe en ENTRADA (XSUB) y reenvía en SALIDA (XPUB)
+BROKER_ENTRADA_PORT = "5560"
+BROKER_SALIDA_PORT = "5561"
+
+# Threads que procesan comandos en el Servidor (0 = todo en el thread del ROUTER)
+NUM_TRABAJADORES = 0
+# Peticiones atendidas por cada despertar del bucle del Servidor
+LOTE_SERVIDOR = 256
+
+# Modo multi-proceso: procesos que se reparten las identidades y puntos de cada
+# proceso en el anillo de hash consistente
+NUM_FRAGMENTOS = 4
+REPLICAS_ANILLO = 256
+
+# Cola del chat: tamaño máximo y mensajes difundidos por pasada
+TAMANO_COLA_CHAT = 10000
+LOTE_BROADCAST = 1000
+
+# Agrupado del chat: con la ventana > 0, ChatBroadcast espera hasta ese tiempo
+# (segundos) a que se acumulen mensajes y envía cada tema en un solo frame de
+# como mucho MAX_BYTES_AGRUPADO bytes. 0 = un frame por mensaje
+VENTANA_AGRUPADO = 0.0
+MAX_BYTES_AGRUPADO = 64 * 1024
+LONGITUD = struct.Struct("!I")
+
+# Marcas de agua: mensajes que cada conexión encola antes de descartar (o bloquear)
+HWM_ENVIO = 1000
+HWM_RECEPCION = 1000
+
+# Suscriptores lentos (pierden mensajes del chat al llenarse su HWM). Política:
+#   recuperar          pedir al historial lo perdido
+#   descartar_nuevo    dar por perdido lo que descartó el HWM
+#   descartar_antiguo  tirar lo encolado y saltar a lo más reciente
+#   desconectar        cerrar la sesión del cliente tras MAX_PERDIDOS
+# desconectar es cooperativo: el XPUB no sabe qué SUB es de qué identidad, así que
+# el Servidor solo cierra la sesión (según lo que el cliente informa con /perdidos)
+# y es el receptor quien, al recibir la respuesta, deja de escuchar el chat.
+POLITICAS_LENTOS = ("recuperar", "descartar_nuevo", "descartar_antiguo", "desconectar")
+POLITICA_LENTOS = "recuperar"
+MAX_PERDIDOS = 1000
+
+# Latidos: cada cuánto los envía el cliente y tras cuánto silencio caduca su sesión (segundos)
+INTERVALO_LATIDO = 1.0
+PLAZO_LATIDO = 5.0
+RESOLUCION_LATIDO = 0.5
+
+# Salas: nombres válidos (no pueden contener ":" porque forman parte del tema PUB)
+PATRON_SALA = re.compile(r"^[\w-]{1,32}$")
+
+def tema_sala(sala):
+    """Prefijo PUB/SUB de una sala; None es el chat general ("CHAT:")"""
+    return f"SALA:{sala}:" if sala else "CHAT:"
+
+# Confirmación de suscripción: un receptor se suscribe además a un tema propio
+# con este prefijo y ChatBroadcast le publica ese tema en cuanto ve la
+# suscripción, así el receptor sabe que ya no se pierde nada del chat
+PREFIJO_CONFIRMACION = "LISTO:"
+
+# Protocolo binario opcional (se negocia con "/proto binario"). Cada frame lleva:
+#   petición:  versión, operación, id de petición + cuerpo tipado
+#   respuesta: versión, operación, id de petición, estado + cuerpo tipado
+VERSION_BINARIA = 1
+CABECERA_PETICION = struct.Struct("!BBI")
+CABECERA_RESPUESTA = struct.Struct("!BBIB")
+OP_LOGIN, OP_MSG, OP_USERS, OP_SUMA, OP_HORA, OP_STATS, OP_LOGOUT, OP_JOIN, OP_LEAVE = range(1, 10)
+ESTADO_OK, ESTADO_ERROR, ESTADO_DESCONOCIDA, ESTADO_RECHAZADA = range(4)
+DOS_ENTEROS = struct.Struct("!qq")
+ENTERO = struct.Struct("!q")
+REAL = struct.Struct("!d")
+
+# Historial del chat: mensajes guardados por tema, temas con historial,
+# mensajes que recupera un receptor al arrancar o cambiar de sala y mensajes
+# como mucho en una respuesta de /historial
+TAMANO_HISTORIAL = 1000
+MAX_TEMAS_HISTORIAL = 256
+HISTORIAL_INICIAL = 20
+MAX_RESPUESTA_HISTORIAL = 1000
+
+# Lista de usuarios: nombres por página de /users y cambios que se guardan
+# para responder "/users desde <versión>"
+TAMANO_PAGINA_USUARIOS = 50
+MAX_CAMBIOS_USUARIOS = 10000
+
+# Control de admisión: cubetas de tokens por identidad y global (peticiones por
+# segundo y ráfaga; tasa 0 = sin límite), identidades con cubeta como mucho y
+# pendientes en la cola del chat a partir de los cuales se rechaza lo que publica
+# (0 = nunca)
+TASA_CLIENTE = 1000.0
+RAFAGA_CLIENTE = 2000
+TASA_GLOBAL = 0.0
+RAFAGA_GLOBAL = 0
+MAX_CUBETAS = 100000
+UMBRAL_SATURACION = TAMANO_COLA_CHAT * 8 // 10
+
+# Trabajos pesados (p. ej. /suma de vectores): procesos del pool, trabajos en
+# cola o en curso como mucho (los demás se rechazan) y elementos a partir de
+# los cuales una suma de vectores va al pool en vez de hacerse en línea
+PROCESOS_TRABAJOS = 2
+MAX_TRABAJOS = 64
+MIN_ELEMENTOS_TRABAJO = 1000
+
+# Registro persistente del chat (opcional, None = sin registro): directorio,
+# tamaño de cada segmento y mensajes escritos como mucho por cada sincronización.
+# El directorio también se indica con --registro o PYZMQ_REGISTRO.
+DIRECTORIO_REGISTRO = None
+TAMANO_SEGMENTO = 64 * 1024 * 1024
+LOTE_REGISTRO = 4096
+
+# Métricas: cada cuánto se publican (segundos) y cubetas del histograma (la i cubre < 2**i µs)
+INTERVALO_METRICAS = 5.0
+NUM_CUBETAS = 32
+
+# Trazas de extremo a extremo (opcionales): fracción de anuncios del chat que se
+# trazan (0 = desactivadas), fichero Chrome trace-event y trazas guardadas como mucho
+MUESTREO_TRAZAS = 0.0
+FICHERO_TRAZAS = "trazas.json"
+MAX_TRAZAS = 10000
+PREFIJO_TRAZA = "TRAZA:"
+
+class ColaChat(Queue):
+    """Cola acotada entre el Servidor y ChatBroadcast con política de desbordamiento"""
+    POLITICAS = ("descartar_antiguo", "descartar_nuevo", "bloquear")
+
+    def __init__(self, maxsize=TAMANO_COLA_CHAT, politica="descartar_antiguo"):
+        if politica not in self.POLITICAS:
+            raise ValueError(f"Política de desbordamiento desconocida: {politica}")
+        Queue.__init__(self, maxsize)
+        self.politica = politica
+        self.descartados = 0
+        self.despertador = None  # Despertador de ChatBroadcast: se avisa al dejar de estar vacía
+
+    def put(self, item, block=True, timeout=None):
+        """Encola un mensaje; si la cola está llena aplica la política configurada"""
+        if self.politica == "bloquear":
+            return Queue.put(self, item, block, timeout)
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                self.descartados += 1
+                if self.politica == "descartar_nuevo":
+                    return
+                self._get()  # descartar_antiguo: se reemplaza el más viejo
+            else:
+                self.unfinished_tasks += 1
+            self._put(item)
+            self.not_empty.notify()
+
+    def _put(self, item):
+        Queue._put(self, item)
+        if self.despertador is not None and self._qsize() == 1:
+            self.despertador.despertar()
+
+    def drenar(self, maximo=LOTE_BROADCAST, timeout=None):
+        """Espera al primer mensaje y devuelve todos los pendientes (hasta maximo)"""
+        with self.not_empty:
+            if not self._qsize():
+                self.not_empty.wait(timeout)
+            lote = []
+            while self._qsize() and len(lote) < maximo:
+                lote.append(self._get())
+            if lote:
+                self.not_full.notify(len(lote))
+            return lote
+
+def endpoint_bind(direccion):
+    """Puerto ("5555") o endpoint completo (tcp://, ipc://, inproc://) -> endpoint para bind"""
+    direccion = str(direccion)
+    return direccion if "://" in direccion else f"tcp://*:{direccion}"
+
+def endpoint_conexion(direccion, host="localhost"):
+    """Puerto o endpoint -> endpoint para connect (un "tcp://*:p" se conecta a host:p)"""
+    direccion = str(direccion)
+    if "://" not in direccion:
+        return f"tcp://{host}:{direccion}"
+    if direccion.startswith("tcp://*:"):
+        return f"tcp://{host}:{direccion[len('tcp://*:'):]}"
+    return direccion
+
+# inproc:// solo conecta sockets del mismo contexto: los componentes con algún
+# endpoint inproc comparten este (y no lo terminan al pararse)
+_contexto_inproc = None
+_contexto_lock = threading.Lock()
+
+def contexto_para(*endpoints):
+    """Contexto ZMQ para un componente con esos endpoints"""
+    global _contexto_inproc
+    if not any(endpoint.startswith("inproc://") for endpoint in endpoints):
+        return zmq.Context()
+    with _contexto_lock:
+        if _contexto_inproc is None or _contexto_inproc.closed:
+            _contexto_inproc = zmq.Context()
+        return _contexto_inproc
+
+def terminar_contexto(context):
+    """context.term(), salvo si es el contexto compartido de inproc"""
+    if context is not _contexto_inproc:
+        context.term()
+
+def configurar_hwm(socket, envio=HWM_ENVIO, recepcion=HWM_RECEPCION):
+    """Fija SNDHWM/RCVHWM de un socket (antes de bind/connect)"""
+    socket.setsockopt(zmq.SNDHWM, envio)
+    socket.setsockopt(zmq.RCVHWM, recepcion)
+    return socket
+
+class Despertador:
+    """Par PUSH/PULL inproc para sacar a un thread de su poll al instante
+
+    El thread registra `socket` en su poller y cualquier otro thread llama a
+    despertar() (por ejemplo desde detener()), sin esperar a ningún timeout.
+    """
+    def __init__(self, context):
+        self.socket = context.socket(zmq.PULL)
+        self.socket.bind(f"inproc://despertador-{id(self)}")
+        self.aviso = context.socket(zmq.PUSH)
+        self.aviso.connect(f"inproc://despertador-{id(self)}")
+        self.lock = threading.Lock()
+
+    def despertar(self):
+        with self.lock:
+            if self.aviso.closed:
+                return
+            try:
+                self.aviso.send(b"", zmq.NOBLOCK)
+            except zmq.Again:
+                pass  # Ya hay avisos sin leer
+
+    def vaciar(self):
+        while True:
+            try:
+                self.socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+    def cerrar(self):
+        with self.lock:
+            self.aviso.close()
+        self.socket.close()
+
+def esperar_listos(*hilos, timeout=5.0):
+    """Espera a que los threads tengan sus sockets abiertos (su Event `listo`)"""
+    limite = time.monotonic() + timeout
+    return all(hilo.listo.wait(max(0, limite - time.monotonic())) for hilo in hilos)
+
+def empaquetar_lote(mensajes):
+    """Une varios mensajes (bytes) en un frame: cada uno precedido de su longitud (!I)"""
+    partes = []
+    for datos in mensajes:
+        partes.append(LONGITUD.pack(len(datos)))
+        partes.append(datos)
+    return b"".join(partes)
+
+def desempaquetar_lote(paquete):
+    """Inversa de empaquetar_lote: devuelve los textos en orden"""
+    textos = []
+    posicion = 0
+    while posicion < len(paquete):
+        (longitud,) = LONGITUD.unpack_from(paquete, posicion)
+        posicion += LONGITUD.size
+        textos.append(paquete[posicion:posicion + longitud].decode())
+        posicion += longitud
+    return textos
+
+class Metricas:
+    """Contadores e histogramas de latencia del servidor
+
+    Cada thread escribe en su propia porción, así registrar no toma locks ni
+    pierde incrementos con varios trabajadores; instantanea() suma las porciones.
+    """
+    def __init__(self):
+        self.inicio = time.monotonic()
+        self._local = threading.local()
+        self._porciones = []
+        self._lock = threading.Lock()  # Solo para dar de alta porciones nuevas
+    
+    def _porcion(self):
+        try:
+            return self._local.porcion
+        except AttributeError:
+            porcion = self._local.porcion = {"comandos": {}, "contadores": {}}
+            with self._lock:
+                self._porciones.append(porcion)
+            return porcion
+    
+    def registrar_comando(self, verbo, duracion_ns):
+        """Cuenta un comando y su latencia: [cantidad, ns totales, cubetas...]"""
+        comandos = self._porcion()["comandos"]
+        datos = comandos.get(verbo)
+        if datos is None:
+            datos = comandos[verbo] = [0, 0] + [0] * NUM_CUBETAS
+        datos[0] += 1
+        datos[1] += duracion_ns
+        datos[2 + min(NUM_CUBETAS - 1, (duracion_ns // 1000).bit_length())] += 1
+    
+    def incrementar(self, nombre, cantidad=1):
+        contadores = self._porcion()["contadores"]
+        contadores[nombre] = contadores.get(nombre, 0) + cantidad
+    
+    def contador(self, nombre):
+        with self._lock:
+            porciones = list(self._porciones)
+        return sum(porcion["contadores"].get(nombre, 0) for porcion in porciones)
+    
+    def instantanea(self):
+        """Suma de todas las porciones: contadores y, por comando, cantidad y percentiles"""
+        with self._lock:
+            porciones = list(self._porciones)
+        contadores, comandos = {}, {}
+        for porcion in porciones:
+            for nombre, valor in list(porcion["contadores"].items()):
+                contadores[nombre] = contadores.get(nombre, 0) + valor
+            for verbo, datos in list(porcion["comandos"].items()):
+                total = comandos.setdefault(verbo, [0] * len(datos))
+                for i, valor in enumerate(datos):
+                    total[i] += valor
+        return {
+            "uptime_s": round(time.monotonic() - self.inicio, 1),
+            "contadores": contadores,
+            "comandos": {verbo: self._resumen(datos) for verbo, datos in comandos.items()},
+        }
+    
+    @staticmethod
+    def _resumen(datos):
+        cantidad, total_ns, cubetas = datos[0], datos[1], datos[2:]
+        resumen = {"n": cantidad, "media_us": round(total_ns / cantidad / 1000, 1) if cantidad else 0}
+        for nombre, fraccion in (("p50_us", 0.5), ("p99_us", 0.99), ("p999_us", 0.999)):
+            objetivo, acumulado = fraccion * cantidad, 0
+            for i, valor in enumerate(cubetas):
+                acumulado += valor
+                if acumulado >= objetivo:
+                    resumen[nombre] = 2 ** i  # Cota superior de la cubeta
+                    break
+        return resumen
+
+class Traza:
+    """Anuncio muestreado: instantes (time.time_ns) de cada etapa de su recorrido"""
+    __slots__ = ("id", "trazador", "recibido", "encolado", "desencolado", "publicado", "tema")
+
+    def __init__(self, id_traza, trazador, recibido, encolado):
+        self.id = id_traza
+        self.trazador = trazador
+        self.recibido = recibido  # atender() empezó con la petición
+        self.encolado = encolado  # el anuncio entró en cola_chat
+        self.desencolado = None  # ChatBroadcast lo sacó de la cola
+        self.publicado = None  # salió por el XPUB
+        self.tema = None
+
+    def frame(self):
+        return f"{PREFIJO_TRAZA}{self.id}".encode()
+
+class Trazador:
+    """Trazas muestreadas del recorrido ROUTER -> cola_chat -> XPUB -> SUB
+
+    atender() anota cuándo empezó cada petición; si su anuncio sale muestreado
+    viaja por la cola como (sala, texto, Traza) y ChatBroadcast lo publica con
+    un frame más (PREFIJO_TRAZA + id). Los receptores informan con /traza de
+    cuándo les llegó. guardar() escribe los tramos en formato Chrome
+    trace-event (chrome://tracing, Perfetto) y el resumen por etapa.
+    
+    max_trazas acota el fichero (solo las primeras) y las publicadas que
+    esperan entregas (las más recientes); el resumen cuenta todas.
+    """
+    def __init__(self, muestreo=MUESTREO_TRAZAS, fichero=FICHERO_TRAZAS, max_trazas=MAX_TRAZAS):
+        self.muestreo = muestreo
+        self.fichero = fichero
+        self.max_trazas = max_trazas
+        self.ids = itertools.count(1)
+        self._local = threading.local()
+        self.eventos = []
+        self.publicadas = OrderedDict()  # id -> Traza publicada, a la espera de entregas
+        self.etapas = Metricas()  # Histograma de cada etapa, como los de los comandos
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+    
+    def peticion(self):
+        """El thread actual empieza a atender una petición"""
+        self._local.recibido = time.time_ns()
+    
+    def muestrear(self, anuncio):
+        """El anuncio tal cual o, si sale muestreado, (sala, texto, Traza)"""
+        if random.random() >= self.muestreo:
+            return anuncio
+        ahora = time.time_ns()
+        traza = Traza(next(self.ids), self, getattr(self._local, "recibido", ahora), ahora)
+        if isinstance(anuncio, tuple):
+            return anuncio + (traza,)
+        return (None, anuncio, traza)
+    
+    def publicada(self, traza, tema):
+        """ChatBroadcast publicó el anuncio: se guardan sus tramos en el servidor"""
+        traza.publicado = time.time_ns()
+        traza.tema = tema
+        eventos = [
+            {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": traza.id,
+             "args": {"name": f"traza {traza.id} ({tema})"}},
+            self._tramo("servidor", traza, traza.recibido, traza.publicado),
+            self._tramo("atender", traza, traza.recibido, traza.encolado),
+            self._tramo("cola_chat", traza, traza.encolado, traza.desencolado),
+            self._tramo("publicar", traza, traza.desencolado, traza.publicado),
+        ]
+        with self.lock:
+            if traza.id <= self.max_trazas:
+                self.eventos.extend(eventos)
+            self.publicadas[traza.id] = traza
+            if len(self.publicadas) > self.max_trazas:
+                self.publicadas.popitem(last=False)
+    
+    def entrega(self, id_traza, recibido, cliente):
+        """Un receptor informa de cuándo le llegó el anuncio; False si no se conoce"""
+        with self.lock:
+            traza = self.publicadas.get(id_traza)
+        if traza is None or recibido < traza.publicado:
+            return False
+        evento = self._tramo("entrega", traza, traza.publicado, recibido, cliente=cliente,
+                             total_us=(recibido - traza.recibido) / 1000)
+        self.etapas.registrar_comando("total", recibido - traza.recibido)
+        if traza.id <= self.max_trazas:
+            with self.lock:
+                self.eventos.append(evento)
+        return True
+    
+    def _tramo(self, nombre, traza, inicio, fin, **args):
+        self.etapas.registrar_comando(nombre, fin - inicio)
+        evento = {"name": nombre, "cat": "chat", "ph": "X", "pid": self.pid, "tid": traza.id,
+                  "ts": inicio / 1000, "dur": (fin - inicio) / 1000}
+        if args:
+            evento["args"] = args
+        return evento
+    
+    def resumen(self):
+        """Por etapa: cantidad, media y percentiles (µs)"""
+        return self.etapas.instantanea()["comandos"]
+    
+    def guardar(self):
+        """Escribe el fichero de trazas (se reemplaza entero)"""
+        with self.lock:
+            eventos = list(self.eventos)
+        datos = {
+            "traceEvents": eventos,
+            "displayTimeUnit": "ms",
+            "otherData": {"muestreo": self.muestreo, "etapas": self.resumen()},
+        }
+        temporal = f"{self.fichero}.tmp"
+        with open(temporal, "w") as f:
+            json.dump(datos, f)
+        os.replace(temporal, self.fichero)
+
+class HistorialChat:
+    """Buffer circular de los últimos mensajes difundidos, por tema y con secuencia
+
+    Cada tema (chat general o sala) numera sus mensajes 1, 2, 3... Un receptor que
+    ve un salto en la secuencia pide al Servidor solo lo que le falta (/historial).
+    La memoria está acotada: TAMANO_HISTORIAL mensajes por tema y MAX_TEMAS_HISTORIAL
+    temas (se olvida el historial del tema con menos actividad reciente). De un
+    tema olvidado solo queda el suelo: si vuelve, numera por encima de todo lo
+    olvidado, así su secuencia nunca retrocede para quien lo seguía.
+    """
+    def __init__(self, tamano=TAMANO_HISTORIAL, max_temas=MAX_TEMAS_HISTORIAL):
+        self.tamano = tamano
+        self.max_temas = max_temas
+        self.temas = OrderedDict()  # tema -> deque[(seq, texto)]
+        self.ultimas = OrderedDict()  # tema -> última secuencia asignada
+        self.suelo = 0  # Mayor secuencia de los temas olvidados
+        self.lock = threading.Lock()
+    
+    def agregar(self, tema, texto):
+        """Guarda un mensaje y devuelve su número de secuencia dentro del tema"""
+        with self.lock:
+            mensajes = self.temas.get(tema)
+            if mensajes is None:
+                mensajes = self.temas[tema] = deque(maxlen=self.tamano)
+                if len(self.temas) > self.max_temas:
+                    self.temas.popitem(last=False)
+            else:
+                self.temas.move_to_end(tema)
+            seq = self.ultimas.get(tema, self.suelo) + 1
+            self.ultimas[tema] = seq
+            self.ultimas.move_to_end(tema)
+            self._recortar()
+            mensajes.append((seq, texto))
+            return seq
+    
+    def _recortar(self):
+        """Olvida las secuencias de los temas menos activos por encima de max_temas"""
+        while len(self.ultimas) > self.max_temas:
+            _, seq = self.ultimas.popitem(last=False)
+            self.suelo = max(self.suelo, seq)
+    
+    def desde(self, tema, seq, limite=None):
+        """Mensajes del tema con secuencia > seq (los `limite` más recientes si se indica)"""
+        with self.lock:
+            mensajes = self.temas.get(tema)
+            if not mensajes:
+                return []
+            # Las secuencias son consecutivas: la posición se calcula, no se busca
+            inicio = max(0, seq - mensajes[0][0] + 1)
+            if limite is not None:
+                inicio = max(inicio, len(mensajes) - limite)
+            return list(itertools.islice(mensajes, inicio, None))
+    
+    def ultima(self, tema):
+        """Última secuencia asignada en el tema (0 si no tiene mensajes)"""
+        with self.lock:
+            return self.ultimas.get(tema, 0)
+    
+    def continuar(self, ultimas):
+        """Sigue numerando a partir de las secuencias dadas (p. ej. las de RegistroChat)"""
+        with self.lock:
+            for tema, seq in ultimas.items():
+                self.ultimas[tema] = max(seq, self.ultimas.get(tema, self.suelo))
+            self._recortar()
+
+class RegistroChat(threading.Thread):
+    """Registro en disco de todo lo difundido: segmentos append-only mapeados en memoria
+
+    Cada segmento es un fichero <posición inicial>.log de TAMANO_SEGMENTO bytes
+    (reservado con ceros) con registros [cabecera, tema, texto]. ChatBroadcast
+    entrega lotes con anotar(); el thread los escribe en el mapa y sincroniza
+    una sola vez por grupo de lotes. El índice (tema -> posición de cada
+    secuencia) se reconstruye leyendo los segmentos al abrir, así un servidor
+    reiniciado sigue sirviendo /historial. Las lecturas van directamente
+    sobre el mmap.
+    """
+    CABECERA = struct.Struct("!IHQ")  # longitud del texto, longitud del tema, secuencia
+    
+    def __init__(self, directorio, tamano_segmento=TAMANO_SEGMENTO, metricas=None):
+        threading.Thread.__init__(self)
+        self.activo = True
+        self.daemon = True
+        self.directorio = directorio
+        self.tamano_segmento = tamano_segmento
+        self.metricas = metricas
+        self.pendientes = Queue()
+        self.lock = threading.Lock()
+        self.bases = []  # posición global donde empieza cada segmento
+        self.mapas = []  # mmap de cada segmento
+        self.indices = {}  # tema -> [primera secuencia, array de posiciones globales]
+        self.escrito = 0  # bytes usados en el último segmento
+        
+        os.makedirs(directorio, exist_ok=True)
+        for nombre in sorted(os.listdir(directorio)):
+            if nombre.endswith(".log"):
+                self._abrir_segmento(int(nombre[:-4]))
+                self.escrito = self._indexar(len(self.mapas) - 1)
+        if not self.mapas:
+            self._abrir_segmento(0)
+    
+    def _abrir_segmento(self, base, tamano=None):
+        ruta = os.path.join(self.directorio, f"{base:020d}.log")
+        with open(ruta, "a+b") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                f.truncate(max(tamano or 0, self.tamano_segmento))
+            self.mapas.append(mmap.mmap(f.fileno(), 0))
+        self.bases.append(base)
+    
+    def _indexar(self, segmento):
+        """Recorre los registros de un segmento; devuelve dónde termina el último"""
+        mapa, base = self.mapas[segmento], self.bases[segmento]
+        posicion = 0
+        while posicion + self.CABECERA.size <= len(mapa):
+            largo_texto, largo_tema, seq = self.CABECERA.unpack_from(mapa, posicion)
+            if not largo_tema:
+                break  # Zona reservada sin escribir
+            inicio_tema = posicion + self.CABECERA.size
+            tema = mapa[inicio_tema:inicio_tema + largo_tema].decode()
+            self._anotar_indice(tema, seq, base + posicion)
+            posicion = inicio_tema + largo_tema + largo_texto
+        return posicion
+    
+    def _anotar_indice(self, tema, seq, posicion):
+        indice = self.indices.get(tema)
+        if indice is None or seq != indice[0] + len(indice[1]):
+            # Tema nuevo o numeración reiniciada: el índice empieza en esta secuencia
+            indice = self.indices[tema] = [seq, array("Q")]
+        indice[1].append(posicion)
+    
+    def ultimas(self):
+        """tema -> última secuencia registrada"""
+        with self.lock:
+            return {tema: primera + len(posiciones) - 1
+                    for tema, (primera, posiciones) in self.indices.items()}
+    
+    def anotar(self, registros):
+        """Encola [(tema, seq, texto), ...] para escribirlos en el próximo grupo"""
+        self.pendientes.put(registros)
+    
+    def run(self):
+        # detener() encola None detrás de lo pendiente: se escribe todo y se sale
+        fin = False
+        while not fin:
+            registros = self.pendientes.get()
+            if registros is None:
+                break
+            registros = list(registros)
+            # Commit en grupo: todos los lotes que esperan, una sola sincronización
+            while len(registros) < LOTE_REGISTRO:
+                try:
+                    siguientes = self.pendientes.get_nowait()
+                except Empty:
+                    break
+                if siguientes is None:
+                    fin = True
+                    break
+                registros.extend(siguientes)
+            self._escribir(registros)
+    
+    def _escribir(self, registros):
+        mapa = self.mapas[-1]
+        inicio = self.escrito
+        nuevos = []
+        for tema, seq, texto in registros:
+            tema_datos, texto_datos = tema.encode(), texto.encode()
+            cuerpo = tema_datos + texto_datos
+            largo = self.CABECERA.size + len(cuerpo)
+            if self.escrito + largo > len(mapa):
+                self._sincronizar(mapa, inicio)
+                with self.lock:
+                    self._abrir_segmento(self.bases[-1] + self.escrito, largo)
+                mapa, inicio, self.escrito = self.mapas[-1], 0, 0
+            posicion = self.escrito
+            # El cuerpo antes que la cabecera: un registro a medias no llega a leerse
+            mapa[posicion + self.CABECERA.size:posicion + largo] = cuerpo
+            self.CABECERA.pack_into(mapa, posicion, len(texto_datos), len(tema_datos), seq)
+            self.escrito += largo
+            nuevos.append((tema, seq, self.bases[-1] + posicion))
+        self._sincronizar(mapa, inicio)
+        
+        with self.lock:
+            for tema, seq, posicion in nuevos:
+                self._anotar_indice(tema, seq, posicion)
+        if self.metricas:
+            self.metricas.incrementar("registro_escritos", len(registros))
+    
+    def _sincronizar(self, mapa, inicio):
+        """msync de lo escrito desde `inicio` (el offset ha de ir alineado a página)"""
+        desde = inicio - inicio % mmap.PAGESIZE
+        if self.escrito > desde:
+            mapa.flush(desde, self.escrito - desde)
+    
+    def leer(self, tema, desde, hasta=None, limite=None):
+        """Mensajes del tema con desde < seq <= hasta (los `limite` últimos si se indica)"""
+        with self.lock:
+            indice = self.indices.get(tema)
+            if indice is None:
+                return []
+            primera, posiciones = indice
+            ultima = primera + len(posiciones) - 1
+            hasta = ultima if hasta is None else min(hasta, ultima)
+            inicio = max(desde + 1, primera)
+            if limite is not None:
+                inicio = max(inicio, hasta - limite + 1)
+            if inicio > hasta:
+                return []
+            seleccion = posiciones[inicio - primera:hasta - primera + 1]
+            bases, mapas = list(self.bases), list(self.mapas)
+        
+        mensajes = []
+        segmento = -1
+        for posicion in seleccion:
+            if segmento < 0 or not bases[segmento] <= posicion < fin_segmento:
+                segmento = bisect.bisect_right(bases, posicion) - 1
+                mapa = mapas[segmento]
+                fin_segmento = bases[segmento + 1] if segmento + 1 < len(bases) else math.inf
+            desplazamiento = posicion - bases[segmento]
+            largo_texto, largo_tema, seq = self.CABECERA.unpack_from(mapa, desplazamiento)
+            inicio_texto = desplazamiento + self.CABECERA.size + largo_tema
+            # El texto se decodifica desde una vista del mapa, sin copia intermedia
+            with memoryview(mapa) as vista:
+                mensajes.append((seq, str(vista[inicio_texto:inicio_texto + largo_texto], "utf-8")))
+        return mensajes
+    
+    def detener(self):
+        self.activo = False
+        self.pendientes.put(None)
+    
+    def cerrar(self):
+        """Libera los mapas (llamar cuando el thread ya terminó)"""
+        with self.lock:
+            for mapa in self.mapas:
+                mapa.close()
+            self.mapas, self.bases, self.indices = [], [], {}
+
+class ListaUsuarios:
+    """Usuarios conectados con número de versión, registro de cambios e instantánea
+
+    Solo alta() y baja() modifican la lista, siempre con `lock` tomado (el del
+    ProcesadorComandos). Cada cambio sube la versión y se añade a un registro
+    append-only. Las lecturas no toman ese lock: la instantánea de una versión
+    se construye una sola vez, aplicando los cambios a la instantánea anterior,
+    y después se reutiliza hasta el siguiente cambio.
+    """
+    def __init__(self, lock, max_cambios=MAX_CAMBIOS_USUARIOS):
+        self.lock = lock
+        self.max_cambios = max_cambios
+        self.nombres = {}  # identidad -> nombre
+        self.version = 0
+        # (versión previa al primer cambio guardado, [(identidad, nombre, es_alta)])
+        self._cambios = (0, [])
+        self._instantanea = (0, {}, ())  # versión, identidad -> nombre, nombres
+        self.lock_instantanea = threading.Lock()
+    
+    def __len__(self):
+        return len(self.nombres)
+    
+    def alta(self, identidad, nombre):
+        anterior = self.nombres.get(identidad)
+        if anterior == nombre:
+            return
+        if anterior is not None:
+            self._anotar(identidad, anterior, False)
+        self.nombres[identidad] = nombre
+        self._anotar(identidad, nombre, True)
+    
+    def baja(self, identidad):
+        """Quita al usuario y devuelve su nombre (None si no estaba)"""
+        nombre = self.nombres.pop(identidad, None)
+        if nombre is not None:
+            self._anotar(identidad, nombre, False)
+        return nombre
+    
+    def _anotar(self, identidad, nombre, es_alta):
+        base, cambios = self._cambios
+        cambios.append((identidad, nombre, es_alta))
+        self.version += 1
+        if len(cambios) > 2 * self.max_cambios:
+            # Se recorta en una lista nueva: quien lea la anterior la sigue viendo entera
+            self._cambios = (self.version - self.max_cambios, cambios[-self.max_cambios:])
+    
+    def cambios_desde(self, version):
+        """(versión actual, cambios posteriores a `version`), o cambios None si ya no se guardan"""
+        actual = self.version  # Antes que el registro: este contiene al menos hasta `actual`
+        base, cambios = self._cambios
+        if version < base or version > actual:
+            return actual, None
+        return actual, cambios[version - base:actual - base]
+    
+    def instantanea(self):
+        """(versión, tupla de nombres) sin tomar el lock de los escritores"""
+        version, nombres, tupla = self._instantanea
+        if version == self.version:
+            return version, tupla
+        with self.lock_instantanea:
+            version, nombres, tupla = self._instantanea
+            actual, cambios = self.cambios_desde(version)
+            if actual != version:
+                if cambios is None:
+                    # Demasiado atrasada para reconstruirla con los cambios: copia completa
+                    with self.lock:
+                        actual, nombres = self.version, dict(self.nombres)
+                else:
+                    nombres = dict(nombres)
+                    for identidad, nombre, es_alta in cambios:
+                        if es_alta:
+                            nombres[identidad] = nombre
+                        else:
+                            nombres.pop(identidad, None)
+                tupla = tuple(nombres.values())
+                self._instantanea = (actual, nombres, tupla)
+            return actual, tupla
+
+class Comando:
+    """Entrada del registro: manejador y cómo debe invocarlo procesar_comando
+
+    usa_lock: el manejador corre con self.lock tomado (lee o modifica clientes_conectados)
+    publica: el manejador devuelve (respuesta, anuncio) y el anuncio va al chat
+    esencial: se admite aunque publique con la cola del chat saturada (p. ej. /logout)
+    """
+    __slots__ = ("manejador", "usa_lock", "publica", "esencial")
+
+    def __init__(self, manejador, usa_lock=False, publica=False, esencial=False):
+        self.manejador = manejador
+        self.usa_lock = usa_lock
+        self.publica = publica
+        self.esencial = esencial
+
+# Comandos disponibles en todo ProcesadorComandos: verbo -> Comando
+COMANDOS = {}
+
+def comando(verbo, usa_lock=False, publica=False, esencial=False):
+    """Decorador que registra manejador(procesador, identidad, args) para ese verbo"""
+    def registrar(manejador):
+        COMANDOS[verbo] = Comando(manejador, usa_lock, publica, esencial)
+        return manejador
+    return registrar
+
+# Operaciones del protocolo binario: código -> Comando, y su verbo para las métricas
+OPERACIONES = {}
+VERBOS_OPERACION = {}
+
+def operacion(codigo, verbo, usa_lock=False, publica=False, esencial=False):
+    """Decorador que registra manejador(procesador, identidad, cuerpo) para una operación binaria
+
+    El manejador devuelve el cuerpo de la respuesta en bytes y lanza ValueError
+    si la petición no es válida.
+    """
+    def registrar(manejador):
+        OPERACIONES[codigo] = Comando(manejador, usa_lock, publica, esencial)
+        VERBOS_OPERACION[codigo] = verbo
+        return manejador
+    return registrar
+
+class ControlAdmision:
+    """Decide en O(1), antes de ejecutar un comando, si se admite
+
+    Cada identidad tiene una cubeta de tokens (tasa por segundo, capacidad
+    `rafaga`) y hay otra global; las cubetas se rellenan al consultarlas. Las
+    identidades sin actividad reciente pierden su cubeta cuando hay más de
+    max_cubetas. Con la cola del chat por encima de `umbral` se rechazan los
+    comandos que publican (salvo los esenciales).
+    """
+    def __init__(self, cola_chat, tasa_cliente=TASA_CLIENTE, rafaga_cliente=RAFAGA_CLIENTE,
+                 tasa_global=TASA_GLOBAL, rafaga_global=RAFAGA_GLOBAL,
+                 umbral=UMBRAL_SATURACION, max_cubetas=MAX_CUBETAS):
+        self.cola_chat = cola_chat
+        self.tasa_cliente = tasa_cliente
+        self.rafaga_cliente = rafaga_cliente
+        self.tasa_global = tasa_global
+        self.rafaga_global = rafaga_global
+        self.umbral = umbral
+        self.max_cubetas = max_cubetas
+        self.cubetas = OrderedDict()  # identidad -> [tokens, instante], la más antigua primero
+        self.cubeta_global = [rafaga_global, time.monotonic()]
+        self.lock = threading.Lock()
+    
+    def admitir(self, identidad, entrada):
+        """None si se admite; si no, "limite" o "saturado" """
+        if (entrada is not None and entrada.publica and not entrada.esencial
+                and self.umbral and self.cola_chat.qsize() >= self.umbral):
+            return "saturado"
+        if self.tasa_cliente <= 0 and self.tasa_global <= 0:
+            return None
+        
+        ahora = time.monotonic()
+        with self.lock:
+            cubeta = None
+            if self.tasa_cliente > 0:
+                cubeta = self.cubetas.get(identidad)
+                if cubeta is None:
+                    cubeta = self.cubetas[identidad] = [self.rafaga_cliente, ahora]
+                    if len(self.cubetas) > self.max_cubetas:
+                        self.cubetas.popitem(last=False)
+                else:
+                    self.cubetas.move_to_end(identidad)
+                    self._rellenar(cubeta, self.tasa_cliente, self.rafaga_cliente, ahora)
+                if cubeta[0] < 1:
+                    return "limite"
+            if self.tasa_global > 0:
+                self._rellenar(self.cubeta_global, self.tasa_global, self.rafaga_global, ahora)
+                if self.cubeta_global[0] < 1:
+                    return "limite"
+                self.cubeta_global[0] -= 1
+            if cubeta is not None:
+                cubeta[0] -= 1
+        return None
+    
+    @staticmethod
+    def _rellenar(cubeta, tasa, rafaga, ahora):
+        cubeta[0] = min(rafaga, cubeta[0] + (ahora - cubeta[1]) * tasa)
+        cubeta[1] = ahora
+
+# Respuesta rápida para las peticiones que no se admiten
+RECHAZOS = {
+    "limite": "⛔ Demasiadas peticiones: espera un momento",
+    "saturado": "⛔ Chat saturado: inténtalo en unos segundos",
+}
+
+def _vector(texto):
+    """"1,2,3" -> vector de enteros (o de reales si alguno no es entero)"""
+    valores = texto.split(",")
+    if np is not None:
+        try:
+            return np.array(valores, dtype=np.int64)
+        except ValueError:
+            return np.array(valores, dtype=np.float64)
+    try:
+        return [int(valor) for valor in valores]
+    except ValueError:
+        return [float(valor) for valor in valores]
+
+def sumar_vectores(a, b):
+    """Suma elemento a elemento "a1,a2,..." y "b1,b2,..." (corre en el pool de trabajos)"""
+    try:
+        x, y = _vector(a), _vector(b)
+    except ValueError:
+        return "❌ Usa: /suma <n1,n2,...> <m1,m2,...>"
+    if len(x) != len(y):
+        return f"❌ Los vectores tienen distinto tamaño ({len(x)} y {len(y)})"
+    if np is not None:
+        suma = (x + y).tolist()
+    else:
+        suma = [p + q for p, q in zip(x, y)]
+    return f"✅ Resultado ({len(suma)} sumas): " + ",".join(map(str, suma))
+
+class Trabajo:
+    """Comando pesado que se resuelve en el pool: la respuesta sale cuando termina"""
+    __slots__ = ("id", "identidad", "descripcion", "funcion", "args", "sobre", "futuro", "creado")
+
+    def __init__(self, id_trabajo, identidad, descripcion, funcion, args):
+        self.id = id_trabajo
+        self.identidad = identidad
+        self.descripcion = descripcion
+        self.funcion = funcion
+        self.args = args
+        self.sobre = None  # [identidad, vacío, (id_peticion,)] de la petición original
+        self.futuro = None
+        self.creado = time.monotonic()
+
+    @property
+    def estado(self):
+        return "en curso" if self.futuro is not None and self.futuro.running() else "en cola"
+
+class GestorTrabajos:
+    """Pool de procesos para los comandos pesados, con cola acotada
+
+    El manejador del comando reserva un Trabajo (crear) y atender() lo lanza con
+    el sobre de la petición, sin responder. Al terminar, la respuesta sale por
+    un PUSH inproc hacia quien tiene el ROUTER (el bucle del Servidor o sus
+    trabajadores), que la envía a la identidad original. Los procesos se
+    arrancan con el primer trabajo.
+    """
+    def __init__(self, context, procesos=PROCESOS_TRABAJOS, max_trabajos=MAX_TRABAJOS, metricas=None):
+        self.procesos = procesos
+        self.max_trabajos = max_trabajos
+        self.metricas = metricas
+        self.ejecutor = None
+        self.trabajos = {}  # id -> Trabajo, en cola o en curso
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.endpoint = f"inproc://trabajos-{id(self)}"
+        self.salida = context.socket(zmq.PUSH)
+        self.salida.bind(self.endpoint)
+
+    def crear(self, identidad, descripcion, funcion, *args):
+        """Reserva un hueco en la cola; None si está llena"""
+        with self.lock:
+            if len(self.trabajos) >= self.max_trabajos:
+                return None
+            trabajo = Trabajo(next(self.ids), identidad, descripcion, funcion, args)
+            self.trabajos[trabajo.id] = trabajo
+        return trabajo
+
+    def lanzar(self, trabajo, sobre):
+        trabajo.sobre = sobre
+        with self.lock:
+            if self.ejecutor is None:
+                self.ejecutor = ProcessPoolExecutor(self.procesos, multiprocessing.get_context("spawn"))
+            trabajo.futuro = self.ejecutor.submit(trabajo.funcion, *trabajo.args)
+        trabajo.futuro.add_done_callback(lambda futuro: self._terminado(trabajo, futuro))
+
+    def _terminado(self, trabajo, futuro):
+        """Callback del pool: envía la respuesta hacia el ROUTER"""
+        try:
+            respuesta, contador = futuro.result(), "trabajos_completados"
+        except Exception as e:
+            respuesta, contador = f"❌ El trabajo #{trabajo.id} falló: {e}", "trabajos_fallidos"
+        with self.lock:
+            self.trabajos.pop(trabajo.id, None)
+            if not self.salida.closed:
+                self.salida.send_multipart(trabajo.sobre + [respuesta.encode()])
+        if self.metricas:
+            self.metricas.incrementar(contador)
+
+    def de(self, identidad):
+        """Trabajos pendientes de una identidad, en orden de llegada"""
+        with self.lock:
+            return [trabajo for trabajo in self.trabajos.values() if trabajo.identidad == identidad]
+
+    def pendientes(self):
+        return len(self.trabajos)
+
+    def cerrar(self):
+        """Cancela lo que no empezó y deja de enviar respuestas"""
+        with self.lock:
+            ejecutor, self.ejecutor = self.ejecutor, None
+            self.salida.close(linger=0)
+        if ejecutor is not None:
+            ejecutor.shutdown(wait=False, cancel_futures=True)
+
+class ProcesadorComandos:
+    """Estado del chat y procesamiento de comandos, común a Servidor y ServidorAsync"""
+    def __init__(self, cola_chat, registro=None):
+        self.cola_chat = cola_chat
+        self.salas = {}  # identidad -> sala actual (sin entrada = chat general)
+        self.lock = threading.Lock()
+        self.usuarios = ListaUsuarios(self.lock)
+        self.clientes_conectados = self.usuarios.nombres  # Solo lectura: se modifica con usuarios
+        self._texto_usuarios = (-1, "")  # Respuesta de /users cacheada por versión
+        self.comandos = dict(COMANDOS)
+        self.operaciones = dict(OPERACIONES)
+        self.clientes_binarios = set()  # identidades que negociaron el protocolo binario
+        self.perdidos_chat = {}  # identidad -> mensajes del chat que su receptor perdió
+        self.politica_lentos = POLITICA_LENTOS
+        self.metricas = Metricas()
+        self.historial = HistorialChat()
+        self.registro = registro  # RegistroChat: historial más antiguo que el de memoria
+        if registro is not None:
+            self.historial.continuar(registro.ultimas())
+        self.federacion = None  # NodoFederado: replica anuncios y sesiones en otros nodos
+        self.admision = ControlAdmision(cola_chat)
+        self.trabajos = None  # GestorTrabajos: sin él los comandos pesados se hacen en línea
+        self.trazador = None  # Trazador: sin él no se traza nada
+    
+    @property
+    def mensajes_procesados(self):
+        return self.metricas.contador("peticiones")
+    
+    def atender(self, frames):
+        """Procesa un sobre [identidad, vacío, (id_peticion,) mensaje] y devuelve el de respuesta
+
+        Acepta frames como bytes o como zmq.Frame (recv_multipart(copy=False)); en ese
+        caso el sobre se reenvía tal cual sin copiarlo.
+        """
+        if len(frames) not in (3, 4) or len(frames[1]):
+            return None  # Sobre mal formado
+        if self.trazador is not None:
+            self.trazador.peticion()
+        identidad, carga = bytes(frames[0]), bytes(frames[-1])
+        if identidad in self.clientes_binarios and carga[:1] == bytes((VERSION_BINARIA,)):
+            respuesta = self.procesar_binario(identidad, carga)
+        else:
+            respuesta = self.procesar_comando(identidad, carga.decode("utf-8", "replace"))
+            if isinstance(respuesta, Trabajo):
+                # Se responde cuando el pool termine, con el mismo sobre
+                self.trabajos.lanzar(respuesta, [bytes(frame) for frame in frames[:-1]])
+                self.metricas.incrementar("peticiones")
+                return None
+            respuesta = respuesta.encode()
+        self.metricas.incrementar("peticiones")
+        # Mismo sobre (incluye el id de correlación si vino) con la respuesta al final
+        return frames[:-1] + [respuesta]
+    
+    def procesar_comando(self, identidad, comando):
+        """Procesa comandos de los clientes (un solo parseo y búsqueda O(1) del verbo)"""
+        inicio = time.perf_counter_ns()
+        verbo, _, args = comando.partition(" ")
+        entrada = self.comandos.get(verbo)
+        rechazo = self.admision.admitir(identidad, entrada)
+        if rechazo:
+            self.metricas.incrementar(f"rechazos_{rechazo}")
+            return RECHAZOS[rechazo]
+        if entrada is None:
+            # Un único contador para todos los verbos inválidos
+            self.metricas.registrar_comando("desconocido", time.perf_counter_ns() - inicio)
+            return "❓ Comando desconocido. Usa /ayuda"
+        
+        respuesta = self._ejecutar(entrada, identidad, args.strip())
+        self.metricas.registrar_comando(verbo, time.perf_counter_ns() - inicio)
+        return respuesta
+    
+    def procesar_binario(self, identidad, carga):
+        """Procesa una petición binaria y devuelve la respuesta ya empaquetada"""
+        inicio = time.perf_counter_ns()
+        try:
+            version, codigo, id_peticion = CABECERA_PETICION.unpack_from(carga)
+        except struct.error:
+            return CABECERA_RESPUESTA.pack(VERSION_BINARIA, 0, 0, ESTADO_ERROR) + b"Cabecera incompleta"
+        entrada = self.operaciones.get(codigo)
+        rechazo = self.admision.admitir(identidad, entrada)
+        if rechazo:
+            self.metricas.incrementar(f"rechazos_{rechazo}")
+            return (CABECERA_RESPUESTA.pack(VERSION_BINARIA, codigo, id_peticion, ESTADO_RECHAZADA)
+                    + RECHAZOS[rechazo].encode())
+        if entrada is None:
+            self.metricas.registrar_comando("desconocido", time.perf_counter_ns() - inicio)
+            return CABECERA_RESPUESTA.pack(VERSION_BINARIA, codigo, id_peticion, ESTADO_DESCONOCIDA)
+        
+        try:
+            cuerpo = self._ejecutar(entrada, identidad, carga[CABECERA_PETICION.size:])
+            estado = ESTADO_OK
+        except (ValueError, struct.error) as e:
+            cuerpo, estado = str(e).encode(), ESTADO_ERROR
+        self.metricas.registrar_comando(VERBOS_OPERACION[codigo], time.perf_counter_ns() - inicio)
+        return CABECERA_RESPUESTA.pack(VERSION_BINARIA, codigo, id_peticion, estado) + cuerpo
+    
+    def _ejecutar(self, entrada, identidad, args):
+        if entrada.usa_lock:
+            with self.lock:
+                resultado = entrada.manejador(self, identidad, args)
+        else:
+            resultado = entrada.manejador(self, identidad, args)
+        
+        if not entrada.publica:
+            return resultado
+        
+        # El anuncio se encola fuera del lock
+        respuesta, anuncio = resultado
+        if anuncio:
+            self._anunciar(anuncio)
+        return respuesta
+    
+    def _anunciar(self, anuncio):
+        """Encola un anuncio para el chat local y lo envía a los demás nodos"""
+        if self.trazador is not None:
+            self.cola_chat.put(self.trazador.muestrear(anuncio))
+        else:
+            self.cola_chat.put(anuncio)
+        if self.federacion is not None:
+            self.federacion.anuncio(anuncio)
+    
+    def registrar_comando(self, verbo, manejador, usa_lock=False, publica=False, esencial=False):
+        """Añade (o reemplaza) un comando solo en este procesador"""
+        self.comandos[verbo] = Comando(manejador, usa_lock, publica, esencial)
+    
+    def estadisticas(self):
+        """Instantánea de las métricas más el estado de la cola y las sesiones"""
+        datos = self.metricas.instantanea()
+        datos["sesiones_activas"] = len(self.clientes_conectados)
+        datos["cola_chat"] = {
+            "pendientes": self.cola_chat.qsize(),
+            "descartados": getattr(self.cola_chat, "descartados", 0),
+        }
+        with self.lock:
+            lentos = sorted(self.perdidos_chat.items(), key=lambda par: -par[1])[:5]
+            datos["suscriptores_lentos"] = {self._nombre(identidad): n for identidad, n in lentos}
+        if self.trabajos is not None:
+            datos["trabajos"] = {"pendientes": self.trabajos.pendientes(), "maximo": self.trabajos.max_trabajos}
+        return datos
+    
+    def expulsar(self, identidad, motivo="sin respuesta", contador="sesiones_caducadas"):
+        """Da de baja a un cliente que dejó de enviar latidos (o que no sigue el chat)"""
+        with self.lock:
+            nombre = self.usuarios.baja(identidad)
+            self.salas.pop(identidad, None)
+            self.clientes_binarios.discard(identidad)
+            self.perdidos_chat.pop(identidad, None)
+        if nombre is not None:
+            self.metricas.incrementar(contador)
+            if self.federacion is not None:
+                self.federacion.baja(identidad)
+            self._anunciar(f"💤 {nombre} se ha desconectado ({motivo})")
+            print(f"💤 [SERVIDOR] Sesión de '{nombre}' cerrada: {motivo} ({identidad.hex()[:8]})")
+    
+    # Lógica común a los comandos de texto y a las operaciones binarias.
+    # Las que tocan clientes_conectados o salas se llaman con self.lock tomado.
+    
+    def _alta(self, identidad, nombre):
+        self.usuarios.alta(identidad, nombre)
+        if self.federacion is not None:
+            self.federacion.alta(identidad, nombre)
+        print(f"👤 [SERVIDOR] Cliente '{nombre}' conectado ({identidad.hex()[:8]})")
+        return len(self.clientes_conectados), f"🎉 {nombre} se ha conectado!"
+    
+    def _baja(self, identidad):
+        nombre = self.usuarios.baja(identidad) or "Usuario"
+        if self.federacion is not None:
+            self.federacion.baja(identidad)
+        self.salas.pop(identidad, None)
+        self.clientes_binarios.discard(identidad)
+        self.perdidos_chat.pop(identidad, None)
+        return f"👋 {nombre} se ha desconectado"
+    
+    def _nombre(self, identidad):
+        return self.clientes_conectados.get(identidad, f"Usuario-{identidad.hex()[:8]}")
+    
+    def _mensaje(self, identidad, texto):
+        return self._para_sala(identidad, f"💬 {self._nombre(identidad)}: {texto}")
+    
+    def _entrar_sala(self, identidad, sala):
+        self.salas[identidad] = sala
+        return sala, f"➡️ {self._nombre(identidad)} entró en #{sala}"
+    
+    def _salir_sala(self, identidad):
+        sala = self.salas.pop(identidad, None)
+        if sala is None:
+            return None
+        return sala, f"⬅️ {self._nombre(identidad)} salió de #{sala}"
+    
+    def _suma(self, identidad, a, b):
+        resultado = a + b
+        nombre = self.clientes_conectados.get(identidad, "Alguien")
+        return resultado, self._para_sala(identidad, f"🔢 {nombre} calculó: {a} + {b} = {resultado}")
+    
+    def _para_sala(self, identidad, texto):
+        """Anuncio dirigido a la sala del cliente: (sala, texto), o texto si está en el general"""
+        sala = self.salas.get(identidad)
+        return (sala, texto) if sala else texto
+    
+    # Comandos de texto
+    
+    @comando("/login", usa_lock=True, publica=True)
+    def _cmd_login(self, identidad, args):
+        if not args:
+            return "❌ Usa: /login <tu_nombre>", None
+        total, anuncio = self._alta(identidad, args)
+        return f"✅ Bienvenido {args}! Hay {total} usuarios conectados", anuncio
+    
+    @comando("/msg", publica=True)
+    def _cmd_msg(self, identidad, args):
+        if not args:
+            return "❌ Usa: /msg <texto>", None
+        return "✅ Mensaje enviado al chat", self._mensaje(identidad, args)
+    
+    @comando("/join", usa_lock=True, publica=True)
+    def _cmd_join(self, identidad, args):
+        if not PATRON_SALA.match(args):
+            return "❌ Usa: /join <sala> (letras, números, - o _)", None
+        return f"✅ Estás en #{args}", self._entrar_sala(identidad, args)
+    
+    @comando("/leave", usa_lock=True, publica=True)
+    def _cmd_leave(self, identidad, args):
+        anuncio = self._salir_sala(identidad)
+        if anuncio is None:
+            return "❌ No estás en ninguna sala", None
+        return "✅ De vuelta en el chat general", anuncio
+    
+    @comando("/users")
+    def _cmd_users(self, identidad, args):
+        """/users [json] [<página> | desde <versión>]
+
+        Sin argumentos, la lista completa (cacheada por versión). Con página,
+        TAMANO_PAGINA_USUARIOS nombres. Con "desde", solo altas y bajas
+        posteriores a esa versión (o la lista completa si ya no se guardan).
+        Ninguna forma toma self.lock.
+        """
+        partes = args.split()
+        como_json = partes[:1] == ["json"]
+        if como_json:
+            partes = partes[1:]
+        
+        if partes[:1] == ["desde"]:
+            try:
+                version = int(partes[1])
+            except (IndexError, ValueError):
+                return "❌ Usa: /users desde <versión>"
+            return self._cambios_usuarios(version, como_json)
+        
+        try:
+            pagina = int(partes[0]) if partes else None
+        except ValueError:
+            return "❌ Usa: /users [página | desde <versión>]"
+        if pagina is not None or como_json:
+            return self._pagina_usuarios(pagina or 1, como_json)
+        
+        version, texto = self._texto_usuarios
+        if version != self.usuarios.version:
+            version, nombres = self.usuarios.instantanea()
+            if nombres:
+                lista = "\n".join([f"  👤 {nombre}" for nombre in nombres])
+                texto = f"👥 Usuarios conectados ({len(nombres)}, v{version}):\n{lista}"
+            else:
+                texto = "📭 No hay usuarios conectados"
+            self._texto_usuarios = (version, texto)
+        return texto
+    
+    def _pagina_usuarios(self, pagina, como_json):
+        version, nombres = self.usuarios.instantanea()
+        paginas = max(1, -(-len(nombres) // TAMANO_PAGINA_USUARIOS))
+        pagina = min(max(pagina, 1), paginas)
+        inicio = (pagina - 1) * TAMANO_PAGINA_USUARIOS
+        seleccion = nombres[inicio:inicio + TAMANO_PAGINA_USUARIOS]
+        if como_json:
+            return json.dumps({"version": version, "pagina": pagina, "paginas": paginas,
+                               "total": len(nombres), "usuarios": seleccion})
+        if not nombres:
+            return "📭 No hay usuarios conectados"
+        lista = "\n".join([f"  👤 {nombre}" for nombre in seleccion])
+        return f"👥 Usuarios conectados ({len(nombres)}, v{version}) - página {pagina}/{paginas}:\n{lista}"
+    
+    def _cambios_usuarios(self, version, como_json):
+        actual, cambios = self.usuarios.cambios_desde(version)
+        if cambios is None:
+            # Versión demasiado antigua (o futura): se manda la lista completa
+            actual, nombres = self.usuarios.instantanea()
+            if como_json:
+                return json.dumps({"version": actual, "completa": True, "usuarios": list(nombres)})
+            return f"🔄 v{actual} (lista completa): " + ", ".join(nombres)
+        # En orden: "+nombre" alta, "-nombre" baja
+        cambios = [("+" if es_alta else "-") + nombre for _, nombre, es_alta in cambios]
+        if como_json:
+            return json.dumps({"version": actual, "cambios": cambios})
+        if not cambios:
+            return f"🔄 v{actual}: sin cambios"
+        return f"🔄 v{actual}: " + " ".join(cambios)
+    
+    @comando("/suma", publica=True)
+    def _cmd_suma(self, identidad, args):
+        """/suma <num1> <num2> | /suma <n1,n2,...> <m1,m2,...> (vectores, sin anuncio)"""
+        partes = args.split()
+        if len(partes) == 2 and "," in args:
+            # Vectores grandes al pool: el bucle del ROUTER sigue atendiendo
+            if self.trabajos is None or partes[0].count(",") + 1 < MIN_ELEMENTOS_TRABAJO:
+                return sumar_vectores(*partes), None
+            trabajo = self.trabajos.crear(identidad, "/suma de vectores", sumar_vectores, *partes)
+            if trabajo is None:
+                self.metricas.incrementar("rechazos_trabajos")
+                return f"⛔ Cola de trabajos llena ({self.trabajos.max_trabajos}): inténtalo más tarde", None
+            return trabajo, None
+        try:
+            a, b = int(partes[0]), int(partes[1])
+        except (IndexError, ValueError):
+            return "❌ Usa: /suma <num1> <num2>", None
+        resultado, anuncio = self._suma(identidad, a, b)
+        return f"✅ Resultado: {resultado}", anuncio
+    
+    @comando("/trabajos")
+    def _cmd_trabajos(self, identidad, args):
+        """Estado de los trabajos pendientes de este cliente"""
+        if self.trabajos is None:
+            return "📭 Este servidor no usa pool de trabajos"
+        propios = self.trabajos.de(identidad)
+        cabecera = f"⚙️ Trabajos en el servidor: {self.trabajos.pendientes()}/{self.trabajos.max_trabajos}"
+        if not propios:
+            return cabecera + "\n  📭 No tienes trabajos pendientes"
+        ahora = time.monotonic()
+        return cabecera + "\n" + "\n".join(
+            f"  #{trabajo.id} {trabajo.descripcion}: {trabajo.estado} ({ahora - trabajo.creado:.1f} s)"
+            for trabajo in propios)
+    
+    @comando("/proto", usa_lock=True)
+    def _cmd_proto(self, identidad, args):
+        """/proto binario [versión] | /proto texto"""
+        partes = args.split()
+        if partes[:1] == ["texto"]:
+            self.clientes_binarios.discard(identidad)
+            return "✅ Protocolo de texto"
+        if partes[:1] == ["binario"]:
+            if len(partes) > 1 and partes[1] != str(VERSION_BINARIA):
+                return f"❌ Versión no soportada (disponible: {VERSION_BINARIA})"
+            self.clientes_binarios.add(identidad)
+            return f"✅ Protocolo binario v{VERSION_BINARIA}"
+        return "❌ Usa: /proto binario [versión] | /proto texto"
+    
+    @comando("/historial")
+    def _cmd_historial(self, identidad, args):
+        """/historial [json] [desde | ultimos <n>] [sala]
+
+        Con `desde`, los mensajes con secuencia mayor (los MAX_RESPUESTA_HISTORIAL
+        más antiguos: el receptor pide el resto después). Con "ultimos", los n
+        más recientes. Sin ninguno de los dos, los HISTORIAL_INICIAL más recientes.
+        """
+        partes = args.split()
+        como_json = bool(partes) and partes[0] == "json"
+        if como_json:
+            partes = partes[1:]
+        try:
+            if partes and partes[0] == "ultimos":
+                desde, limite = 0, min(int(partes[1]), MAX_RESPUESTA_HISTORIAL)
+                partes = partes[1:]
+            else:
+                desde = int(partes[0]) if partes else 0
+                limite = None if desde or como_json else HISTORIAL_INICIAL
+        except (ValueError, IndexError):
+            return "❌ Usa: /historial [desde | ultimos <n>] [sala]"
+        sala = partes[1] if len(partes) > 1 else None
+        tema = tema_sala(sala)
+        mensajes = self.historial.desde(tema, desde, limite)
+        if self.registro is not None and (limite is None or len(mensajes) < limite):
+            # Lo que ya no está en memoria (o se perdió al reiniciar) sale del registro
+            primera = mensajes[0][0] if mensajes else self.historial.ultima(tema) + 1
+            if primera > desde + 1:
+                if limite is None:
+                    hasta, restantes = min(primera - 1, desde + MAX_RESPUESTA_HISTORIAL), None
+                else:
+                    hasta, restantes = primera - 1, limite - len(mensajes)
+                mensajes = self.registro.leer(tema, desde, hasta, restantes) + mensajes
+        if limite is None:
+            del mensajes[MAX_RESPUESTA_HISTORIAL:]
+        
+        if como_json:
+            return json.dumps(mensajes)
+        if not mensajes:
+            return "📭 No hay mensajes en el historial"
+        return "📜 Historial:\n" + "\n".join(f"  #{seq} {texto}" for seq, texto in mensajes)
+    
+    @comando("/hora")
+    def _cmd_hora(self, identidad, args):
+        return f"🕐 Hora: {time.strftime('%H:%M:%S')}"
+    
+    @comando("/stats")
+    def _cmd_stats(self, identidad, args):
+        datos = self.estadisticas()
+        if args == "json":
+            return json.dumps(datos)
+        
+        contadores = datos["contadores"]
+        lineas = [f"📊 Mensajes: {contadores.get('peticiones', 0)} | Usuarios: {datos['sesiones_activas']}",
+                  f"  📬 Cola chat: {datos['cola_chat']['pendientes']} pendientes, "
+                  f"{datos['cola_chat']['descartados']} descartados | "
+                  f"Difundidos: {contadores.get('chat_difundidos', 0)}"]
+        rechazos = contadores.get("rechazos_limite", 0) + contadores.get("rechazos_saturado", 0)
+        if rechazos:
+            lineas.append(f"  ⛔ Rechazadas: {contadores.get('rechazos_limite', 0)} por límite, "
+                          f"{contadores.get('rechazos_saturado', 0)} por saturación")
+        if "trabajos" in datos:
+            lineas.append(f"  ⚙️ Trabajos: {datos['trabajos']['pendientes']}/{datos['trabajos']['maximo']} pendientes, "
+                          f"{contadores.get('trabajos_completados', 0)} completados, "
+                          f"{contadores.get('trabajos_fallidos', 0)} fallidos, "
+                          f"{contadores.get('rechazos_trabajos', 0)} rechazados")
+        if datos["suscriptores_lentos"]:
+            lentos = ", ".join(f"{nombre} ({n})" for nombre, n in datos["suscriptores_lentos"].items())
+            lineas.append(f"  🐢 Perdidos por suscriptor: {lentos}")
+        for verbo, resumen in sorted(datos["comandos"].items()):
+            lineas.append(f"  ⏱️ {verbo}: {resumen['n']} veces, media {resumen['media_us']} µs, "
+                          f"p99 < {resumen.get('p99_us', 0)} µs")
+        return "\n".join(lineas)
+    
+    @comando("/perdidos")
+    def _cmd_perdidos(self, identidad, args):
+        """Informe de un receptor que vio un hueco: /perdidos <n>. Responde la política
+
+        Con "desconectar" se cierra la sesión de login del cliente; su SUB sigue
+        conectado hasta que el receptor, al leer la respuesta, deja de escuchar.
+        """
+        try:
+            perdidos = int(args)
+            if perdidos < 0:
+                raise ValueError
+        except ValueError:
+            return "❌ Usa: /perdidos <n>"
+        with self.lock:
+            total = self.perdidos_chat[identidad] = self.perdidos_chat.get(identidad, 0) + perdidos
+        self.metricas.incrementar("chat_perdidos", perdidos)
+        
+        if self.politica_lentos != "desconectar":
+            return self.politica_lentos
+        if total < MAX_PERDIDOS:
+            return "recuperar"
+        self.expulsar(identidad, "demasiado lento", "lentos_desconectados")
+        return "desconectar"
+    
+    @comando("/traza")
+    def _cmd_traza(self, identidad, args):
+        """Un receptor informa de cuándo le llegó un anuncio trazado: /traza <id> <instante_ns>"""
+        if self.trazador is None:
+            return "❌ Las trazas están desactivadas"
+        try:
+            id_traza, recibido = map(int, args.split())
+        except ValueError:
+            return "❌ Usa: /traza <id> <instante_ns>"
+        if not self.trazador.entrega(id_traza, recibido, self._nombre(identidad)):
+            return "❌ Traza desconocida"
+        return "✅ Traza anotada"
+    
+    @comando("/logout", usa_lock=True, publica=True, esencial=True)
+    def _cmd_logout(self, identidad, args):
+        return "✅ Hasta luego!", self._baja(identidad)
+    
+    # Operaciones binarias (mismos efectos que los comandos, cuerpos tipados)
+    
+    @operacion(OP_LOGIN, "/login", usa_lock=True, publica=True)
+    def _op_login(self, identidad, cuerpo):
+        nombre = cuerpo.decode().strip()
+        if not nombre:
+            raise ValueError("Falta el nombre")
+        total, anuncio = self._alta(identidad, nombre)
+        return ENTERO.pack(total), anuncio
+    
+    @operacion(OP_MSG, "/msg", publica=True)
+    def _op_msg(self, identidad, cuerpo):
+        if not cuerpo:
+            raise ValueError("Mensaje vacío")
+        return b"", self._mensaje(identidad, cuerpo.decode())
+    
+    @operacion(OP_USERS, "/users")
+    def _op_users(self, identidad, cuerpo):
+        # Nombres separados por \0
+        return "\0".join(self.usuarios.instantanea()[1]).encode()
+    
+    @operacion(OP_SUMA, "/suma", publica=True)
+    def _op_suma(self, identidad, cuerpo):
+        resultado, anuncio = self._suma(identidad, *DOS_ENTEROS.unpack(cuerpo))
+        return ENTERO.pack(resultado), anuncio
+    
+    @operacion(OP_HORA, "/hora")
+    def _op_hora(self, identidad, cuerpo):
+        return REAL.pack(time.time())
+    
+    @operacion(OP_STATS, "/stats")
+    def _op_stats(self, identidad, cuerpo):
+        # Peticiones atendidas y usuarios conectados
+        return DOS_ENTEROS.pack(self.mensajes_procesados, len(self.clientes_conectados))
+    
+    @operacion(OP_LOGOUT, "/logout", usa_lock=True, publica=True, esencial=True)
+    def _op_logout(self, identidad, cuerpo):
+        return b"", self._baja(identidad)
+    
+    @operacion(OP_JOIN, "/join", usa_lock=True, publica=True)
+    def _op_join(self, identidad, cuerpo):
+        sala = cuerpo.decode()
+        if not PATRON_SALA.match(sala):
+            raise ValueError("Nombre de sala inválido")
+        return b"", self._entrar_sala(identidad, sala)
+    
+    @operacion(OP_LEAVE, "/leave", usa_lock=True, publica=True)
+    def _op_leave(self, identidad, cuerpo):
+        anuncio = self._salir_sala(identidad)
+        if anuncio is None:
+            raise ValueError("No estás en ninguna sala")
+        return b"", anuncio
+
+class Servidor(ProcesadorComandos, threading.Thread):
+    """Servidor que maneja múltiples clientes simultáneamente
+
+    Con num_trabajadores=0 un solo thread recibe, procesa y responde. Con N > 0 el
+    ROUTER solo reparte las peticiones por inproc a N TrabajadorServidor.
+    `puerto` es un puerto TCP o cualquier endpoint (ipc://, inproc://...).
+    """
+    def __init__(self, cola_chat, num_trabajadores=NUM_TRABAJADORES, registro=None, puerto=SERVIDOR_PORT):
+        threading.Thread.__init__(self)
+        ProcesadorComandos.__init__(self, cola_chat, registro)
+        self.puerto = puerto
+        self.activo = True
+        self.daemon = True
+        self.num_trabajadores = num_trabajadores
+        self.trabajadores = []
+        self.listo = threading.Event()
+        # detener() saca al bucle (o al proxy) por este PAIR inproc, sin esperar timeouts
+        self.context = contexto_para(endpoint_bind(puerto))
+        self.control = self.context.socket(zmq.PAIR)
+        self.control.bind(f"inproc://control-{id(self)}")
+        self.trabajos = GestorTrabajos(self.context, metricas=self.metricas)
+        
+    def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.ROUTER))  # ROUTER maneja múltiples clientes
+        socket.setsockopt(zmq.ROUTER_HANDOVER, 1)  # Una identidad que reconecta reemplaza a la anterior
+        socket.bind(endpoint_bind(self.puerto))
+        
+        print("🟢 [SERVIDOR] Listo para múltiples clientes\n")
+        self.listo.set()
+        
+        if self.num_trabajadores:
+            self._repartir(socket)
+        else:
+            self._atender_en_linea(socket)
+        
+        for trabajador in self.trabajadores:
+            trabajador.detener()
+        for trabajador in self.trabajadores:
+            trabajador.join()
+        socket.close()
+        self.control.close()
+        self.trabajos.cerrar()
+        terminar_contexto(self.context)
+    
+    def _atender_en_linea(self, socket):
+        """Bucle de un solo thread: en cada despertar atiende hasta LOTE_SERVIDOR peticiones"""
+        # Con ROUTER_MANDATORY una respuesta que no cabe (HWM) o sin destinatario
+        # falla en vez de perderse en silencio, y se puede contar
+        socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        resultados = self.context.socket(zmq.PULL)
+        resultados.connect(self.trabajos.endpoint)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.control, zmq.POLLIN)
+        poller.register(resultados, zmq.POLLIN)
+        
+        while self.activo:
+            eventos = dict(poller.poll())
+            if self.control in eventos:
+                break
+            if resultados in eventos:
+                self._entregar_resultados(resultados, socket)
+            
+            for _ in range(LOTE_SERVIDOR):
+                try:
+                    # Recibir: [identidad_cliente, vacío, (id_peticion,) mensaje]
+                    # Los comandos son cortos: copiarlos a bytes sale más barato que crear
+                    # un zmq.Frame por parte (copy=False solo compensa con frames grandes)
+                    frames = socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break  # No quedan peticiones listas
+                
+                try:
+                    respuesta = self.atender(frames)
+                    if respuesta:
+                        # Las respuestas largas (/users) salen sin copia; las cortas
+                        # las copia pyzmq por debajo de copy_threshold
+                        socket.send_multipart(respuesta, zmq.NOBLOCK, copy=False)
+                except zmq.ZMQError:
+                    self.metricas.incrementar("respuestas_perdidas")
+                except Exception as e:
+                    print(f"❌ [SERVIDOR] Error: {e}")
+        
+        resultados.close()
+    
+    def _entregar_resultados(self, resultados, socket):
+        """Envía a su cliente las respuestas de los trabajos que terminaron"""
+        while True:
+            try:
+                respuesta = resultados.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                socket.send_multipart(respuesta, zmq.NOBLOCK)
+            except zmq.ZMQError:
+                self.metricas.incrementar("respuestas_perdidas")
+    
+    def _repartir(self, socket):
+        """ROUTER (clientes) <-> DEALER (trabajadores) hasta recibir TERMINATE"""
+        backend = configurar_hwm(self.context.socket(zmq.DEALER))
+        backend.bind(f"inproc://trabajadores-{id(self)}")
+        
+        self.trabajadores = [TrabajadorServidor(self, self.context, f"inproc://trabajadores-{id(self)}")
+                             for _ in range(self.num_trabajadores)]
+        for trabajador in self.trabajadores:
+            trabajador.start()
+        print(f"👷 [SERVIDOR] {self.num_trabajadores} trabajadores procesando comandos\n")
+        
+        # El reparto lo hace libzmq en C: DEALER alterna entre trabajadores y el
+        # sobre con la identidad viaja intacto, así la respuesta vuelve a su cliente
+        if self.activo:
+            zmq.proxy_steerable(socket, backend, None, self.control)
+        backend.close()
+    
+    def detener(self):
+        self.activo = False
+        try:
+            # Sacar del poll (o de zmq.proxy_steerable) al thread del ROUTER
+            control = self.context.socket(zmq.PAIR)
+        except zmq.ZMQError:
+            return  # Ya terminó
+        control.connect(f"inproc://control-{id(self)}")
+        control.send(b"TERMINATE")
+        control.close()
+
+class TrabajadorServidor(threading.Thread):
+    """Thread del pool que procesa los comandos que le reparte el Servidor
+
+    También devuelve por su DEALER las respuestas de los trabajos del
+    GestorTrabajos.
+    """
+    def __init__(self, servidor, context, endpoint):
+        threading.Thread.__init__(self)
+        self.activo = True
+        self.daemon = True
+        self.servidor = servidor
+        self.context = context
+        self.endpoint = endpoint
+        self.despertador = Despertador(context)
+    
+    def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.DEALER))
+        socket.connect(self.endpoint)
+        resultados = self.context.socket(zmq.PULL)
+        resultados.connect(self.servidor.trabajos.endpoint)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(resultados, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
+        
+        while self.activo:
+            eventos = dict(poller.poll())
+            if resultados in eventos:
+                socket.send_multipart(resultados.recv_multipart())
+            if socket not in eventos:
+                continue
+            try:
+                respuesta = self.servidor.atender(socket.recv_multipart())
+                if respuesta:
+                    socket.send_multipart(respuesta)
+            except Exception as e:
+                print(f"❌ [TRABAJADOR] Error: {e}")
+        
+        socket.close()
+        resultados.close()
+        self.despertador.cerrar()
+    
+    def detener(self):
+        self.activo = False
+        self.despertador.despertar()
+
+class RuedaTemporal:
+    """Rueda de tiempo para caducar sesiones sin recorrerlas todas
+
+    Un latido solo anota el tick en que llegó (O(1)). Cada sesión vive en la ranura
+    del tick en que vencería; al pasar por esa ranura se caduca o, si hubo latidos
+    desde entonces, se mueve a la ranura de su nuevo vencimiento.
+    """
+    def __init__(self, plazo=PLAZO_LATIDO, resolucion=RESOLUCION_LATIDO):
+        self.plazo_ticks = max(1, math.ceil(plazo / resolucion))
+        self.ranuras = [set() for _ in range(self.plazo_ticks + 1)]
+        self.tick = 0
+        self.ultimo_latido = {}  # identidad -> tick del último latido
+    
+    def __len__(self):
+        return len(self.ultimo_latido)
+    
+    def latido(self, identidad):
+        """Alta o renovación de una sesión"""
+        if identidad not in self.ultimo_latido:
+            self._programar(identidad, self.tick + self.plazo_ticks)
+        self.ultimo_latido[identidad] = self.tick
+    
+    def quitar(self, identidad):
+        # La entrada que quede en su ranura se ignora al vencer
+        self.ultimo_latido.pop(identidad, None)
+    
+    def avanzar(self):
+        """Avanza un tick y devuelve las identidades caducadas"""
+        self.tick += 1
+        ranura = self.ranuras[self.tick % len(self.ranuras)]
+        caducadas = []
+        for identidad in ranura:
+            ultimo = self.ultimo_latido.get(identidad)
+            if ultimo is None:
+                continue
+            vence = ultimo + self.plazo_ticks
+            if vence <= self.tick:
+                del self.ultimo_latido[identidad]
+                caducadas.append(identidad)
+            else:
+                self._programar(identidad, vence)
+        ranura.clear()
+        return caducadas
+    
+    def _programar(self, identidad, tick):
+        self.ranuras[tick % len(self.ranuras)].add(identidad)
+
+class ServicioLatidos(threading.Thread):
+    """Recibe los latidos de los clientes en HEARTBEAT_PORT y caduca sesiones sin latidos
+
+    Solo se vigilan los clientes con sesión iniciada que envían latidos; los que
+    nunca envían ninguno (clientes antiguos) se dejan como antes.
+    """
+    def __init__(self, servidor, plazo=PLAZO_LATIDO, resolucion=RESOLUCION_LATIDO, puerto=HEARTBEAT_PORT):
+        threading.Thread.__init__(self)
+        self.activo = True
+        self.daemon = True
+        self.servidor = servidor
+        self.puerto = puerto
+        self.resolucion = resolucion
+        self.rueda = RuedaTemporal(plazo, resolucion)
+        self.listo = threading.Event()
+        self.context = contexto_para(endpoint_bind(puerto))
+        self.despertador = Despertador(self.context)
+    
+    def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.ROUTER))
+        socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        socket.bind(endpoint_bind(self.puerto))
+        
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
+        proximo_tick = time.monotonic() + self.resolucion
+        
+        print("💓 [LATIDOS] Vigilando sesiones\n")
+        self.listo.set()
+        
+        while self.activo:
+            espera = max(0, proximo_tick - time.monotonic())
+            if socket in dict(poller.poll(espera * 1000)):
+                while True:
+                    try:
+                        identidad, _ = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    except ValueError:
+                        continue  # Latido mal formado
+                    if identidad in self.servidor.clientes_conectados:
+                        self.rueda.latido(identidad)
+                    socket.send_multipart([identidad, b"PONG"])
+            
+            while time.monotonic() >= proximo_tick:
+                proximo_tick += self.resolucion
+                for identidad in self.rueda.avanzar():
+                    self.servidor.expulsar(identidad)
+        
+        socket.close()
+        self.despertador.cerrar()
+        terminar_contexto(self.context)
+    
+    def detener(self):
+        self.activo = False
+        self.despertador.despertar()
+
+class PublicadorMetricas(threading.Thread):
+    """Publica periódicamente las métricas del servidor (JSON) en METRICAS_PORT"""
+    def __init__(self, servidor, intervalo=INTERVALO_METRICAS, puerto=METRICAS_PORT):
+        threading.Thread.__init__(self)
+        self.activo = True
+        self.daemon = True
+        self.servidor = servidor
+        self.intervalo = intervalo
+        self.puerto = puerto
+        self.listo = threading.Event()
+        self.context = contexto_para(endpoint_bind(puerto))
+        self.despertador = Despertador(self.context)
+    
+    def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.PUB))
+        socket.bind(endpoint_bind(self.puerto))
+        self.listo.set()
+        
+        anterior, instante_anterior = {}, time.monotonic()
+        while self.activo:
+            if self.despertador.socket.poll(self.intervalo * 1000):
+                break  # detener()
+            datos = self.servidor.estadisticas()
+            ahora = time.monotonic()
+            
+            # Tasas por segundo desde la publicación anterior
+            contadores = datos["contadores"]
+            datos["tasas"] = {nombre: round((valor - anterior.get(nombre, 0)) / (ahora - instante_anterior), 1)
+                              for nombre, valor in contadores.items()}
+            anterior, instante_anterior = contadores, ahora
+            
+            socket.send_string(f"METRICAS:{json.dumps(datos)}")
+        
+        socket.close()
+        self.despertador.cerrar()
+        terminar_contexto(self.context)
+    
+    def detener(self):
+        self.activo = False
+        self.despertador.despertar()
+
+class ChatBroadcast(threading.Thread):
+    """Difunde mensajes del chat a todos los clientes
+
+    Los mensajes de la cola son texto (chat general, tema "CHAT:") o tuplas
+    (sala, texto) que salen con el tema de esa sala, seguidos de un frame con su
+    secuencia en el HistorialChat. El socket es XPUB: libzmq
+    filtra por tema en el lado del publicador, así un mensaje de sala solo viaja
+    a los suscriptores de esa sala.
+    
+    Las marcas de agua acotan la memoria: un suscriptor lento pierde lo que no
+    cabe en su cola (ver /perdidos) sin frenar a los demás. Con XPUB_VERBOSER
+    llegan todas las altas y bajas, así se cuenta cuántos suscriptores tiene
+    cada tema.
+    
+    Con ventana > 0 los mensajes se agrupan: [tema, secuencia del primero,
+    empaquetar_lote(textos)], un frame por tema y pasada en lugar de uno por
+    mensaje, a cambio de hasta `ventana` segundos más de latencia.
+    
+    El thread espera a la vez al XPUB y a la cola (que lo despierta al dejar
+    de estar vacía), así confirma cada suscripción PREFIJO_CONFIRMACION en
+    cuanto llega y detener() surte efecto al momento.
+    
+    Un anuncio trazado llega como (sala, texto, Traza) y sale con un frame
+    más al final, PREFIJO_TRAZA + id (en un lote, el de su primer anuncio trazado).
+    """
+    def __init__(self, cola_chat, metricas=None, historial=None,
+                 ventana=VENTANA_AGRUPADO, max_bytes=MAX_BYTES_AGRUPADO,
+                 hwm_envio=HWM_ENVIO, hwm_recepcion=HWM_RECEPCION, registro=None, puerto=CHAT_PORT):
+        threading.Thread.__init__(self)
+        self.puerto = puerto
+        self.cola_chat = cola_chat
+        self.metricas = metricas
+        self.historial = historial if historial is not None else HistorialChat()
+        self.ventana = ventana
+        self.max_bytes = max_bytes
+        self.hwm_envio = hwm_envio
+        self.hwm_recepcion = hwm_recepcion
+        self.registro = registro  # RegistroChat opcional: recibe cada lote ya difundido
+        self.activo = True
+        self.daemon = True
+        self.suscriptores = {}  # tema -> suscriptores actuales
+        self.listo = threading.Event()
+        self.context = contexto_para(endpoint_bind(puerto))
+        self.despertador = Despertador(self.context)
+        
+    def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.XPUB), self.hwm_envio, self.hwm_recepcion)
+        socket.setsockopt(zmq.XPUB_VERBOSER, 1)
+        socket.bind(endpoint_bind(self.puerto))
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
+        with self.cola_chat.mutex:
+            self.cola_chat.despertador = self.despertador
+        
+        print("📻 [CHAT] Canal de difusión activo\n")
+        self.listo.set()
+        
+        while self.activo:
+            # Despierta en cuanto llega un mensaje (o una suscripción) y difunde
+            # todo lo pendiente; si quedó algo de la pasada anterior no espera
+            eventos = dict(poller.poll(0 if self.cola_chat.qsize() else None))
+            if self.despertador.socket in eventos:
+                self.despertador.vaciar()
+            if socket in eventos:
+                self._leer_suscripciones(socket)
+            lote = self.cola_chat.drenar(LOTE_BROADCAST, timeout=0)
+            if not lote:
+                continue
+            if self.ventana > 0:
+                self._completar_lote(lote)
+            lineas = []
+            registros = []
+            grupos = {}  # tema -> [secuencia del primero, mensajes codificados, bytes]
+            for mensaje in lote:
+                traza = None
+                if isinstance(mensaje, tuple):
+                    if len(mensaje) == 3:
+                        sala, mensaje, traza = mensaje
+                        traza.desencolado = time.time_ns()
+                    else:
+                        sala, mensaje = mensaje
+                else:
+                    sala = None
+                lineas.append(f"📢 [#{sala}] {mensaje}" if sala else f"📢 {mensaje}")
+                tema = tema_sala(sala)
+                seq = self.historial.agregar(tema, mensaje)
+                registros.append((tema, seq, mensaje))
+                if self.ventana <= 0:
+                    # [tema + texto, secuencia]: la secuencia permite detectar huecos
+                    if traza is None:
+                        socket.send_multipart([f"{tema}{mensaje}".encode(), str(seq).encode()])
+                    else:
+                        socket.send_multipart([f"{tema}{mensaje}".encode(), str(seq).encode(), traza.frame()])
+                        traza.trazador.publicada(traza, tema)
+                    continue
+                datos = mensaje.encode()
+                grupo = grupos.get(tema)
+                if grupo is not None and grupo[2] + len(datos) > self.max_bytes:
+                    self._enviar_grupo(socket, tema, grupo)
+                    grupo = None
+                if grupo is None:
+                    grupo = grupos[tema] = [seq, [], 0, []]
+                grupo[1].append(datos)
+                grupo[2] += LONGITUD.size + len(datos)
+                if traza is not None:
+                    grupo[3].append(traza)
+            for tema, grupo in grupos.items():
+                self._enviar_grupo(socket, tema, grupo)
+            if self.registro is not None:
+                self.registro.anotar(registros)
+            if self.metricas:
+                self.metricas.incrementar("chat_difundidos", len(lote))
+            print("\n".join(lineas))
+        
+        with self.cola_chat.mutex:
+            self.cola_chat.despertador = None
+        socket.close()
+        self.despertador.cerrar()
+        terminar_contexto(self.context)
+    
+    def _completar_lote(self, lote):
+        """Sigue drenando la cola hasta agotar la ventana o llenar max_bytes"""
+        fin = time.monotonic() + self.ventana
+        tamano = sum(len(m[1] if isinstance(m, tuple) else m) for m in lote)
+        while tamano < self.max_bytes and len(lote) < LOTE_BROADCAST:
+            restante = fin - time.monotonic()
+            if restante <= 0:
+                break
+            nuevos = self.cola_chat.drenar(LOTE_BROADCAST - len(lote), timeout=restante)
+            lote.extend(nuevos)
+            tamano += sum(len(m[1] if isinstance(m, tuple) else m) for m in nuevos)
+    
+    def _enviar_grupo(self, socket, tema, grupo):
+        seq, mensajes, _, trazas = grupo
+        frames = [tema.encode(), str(seq).encode(), empaquetar_lote(mensajes)]
+        if trazas:
+            # Las entregas se informan por el primero; los demás solo tienen tramos del servidor
+            frames.append(trazas[0].frame())
+        socket.send_multipart(frames)
+        for traza in trazas:
+            traza.trazador.publicada(traza, tema)
+    
+    def _leer_suscripciones(self, socket):
+        """Consume los avisos del XPUB: 1 + tema por cada alta, 0 + tema por cada baja
+
+        Un alta de confirmación se contesta publicando ese mismo tema: solo le
+        llega a quien se suscribió, y después de haber visto sus suscripciones.
+        """
+        while True:
+            try:
+                aviso = socket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if not aviso:
+                continue
+            tema = aviso[1:].decode(errors="replace")
+            if tema.startswith(PREFIJO_CONFIRMACION):
+                if aviso[0] == 1:
+                    socket.send(aviso[1:])
+                continue
+            if aviso[0] == 1:
+                self.suscriptores[tema] = self.suscriptores.get(tema, 0) + 1
+                contador = "chat_altas"
+            else:
+                restantes = self.suscriptores.get(tema, 0) - 1
+                if restantes > 0:
+                    self.suscriptores[tema] = restantes
+                else:
+                    self.suscriptores.pop(tema, None)
+                contador = "chat_bajas"
+            if self.metricas:
+                self.metricas.incrementar(contador)
+    
+    def detener(self):
+        self.activo = False
+        self.despertador.despertar()
+
+class BrokerFederacion(threading.Thread):
+    """Broker XSUB/XPUB que une a los nodos federados
 
-class Servidor(threading.Thread):
-    """Servidor que maneja múltiples clientes simultáneamente"""
-    def __init__(self, cola_chat):
+    Cada nodo publica sus eventos en BROKER_ENTRADA_PORT y se suscribe en
+    BROKER_SALIDA_PORT. libzmq reenvía mensajes y suscripciones en C.
+    
+    Con `interfaz` (p. ej. "tcp://127.0.0.1") escucha en dos puertos libres de
+    esa interfaz; endpoint_entrada y endpoint_salida quedan fijados antes de `listo`.
+    """
+    def __init__(self, puerto_entrada=BROKER_ENTRADA_PORT, puerto_salida=BROKER_SALIDA_PORT, interfaz=None):
         threading.Thread.__init__(self)
         self.activo = True
         self.daemon = True
-        self.cola_chat = cola_chat
-        self.clientes_conectados = {}
-        self.mensajes_procesados = 0
+        self.puerto_entrada = puerto_entrada
+        self.puerto_salida = puerto_salida
+        self.interfaz = interfaz
+        self.endpoint_entrada = None
+        self.endpoint_salida = None
+        self.listo = threading.Event()
+        self.context = zmq.Context()
+        # detener() saca al proxy por este par PAIR inproc, conectado antes de arrancar
+        self.control = self.context.socket(zmq.PAIR)
+        self.control.bind(f"inproc://broker-{id(self)}")
+        self.aviso = self.context.socket(zmq.PAIR)
+        self.aviso.connect(f"inproc://broker-{id(self)}")
         self.lock = threading.Lock()
+    
+    def run(self):
+        entrada = configurar_hwm(self.context.socket(zmq.XSUB))
+        salida = configurar_hwm(self.context.socket(zmq.XPUB))
+        if self.interfaz:
+            self.puerto_entrada = entrada.bind_to_random_port(self.interfaz)
+            self.puerto_salida = salida.bind_to_random_port(self.interfaz)
+            self.endpoint_entrada = f"{self.interfaz}:{self.puerto_entrada}"
+            self.endpoint_salida = f"{self.interfaz}:{self.puerto_salida}"
+        else:
+            entrada.bind(f"tcp://*:{self.puerto_entrada}")
+            salida.bind(f"tcp://*:{self.puerto_salida}")
+        
+        print(f"🛰️  [BROKER] Nodos publican en {self.puerto_entrada} y escuchan en {self.puerto_salida}\n")
+        self.listo.set()
+        if self.activo:
+            zmq.proxy_steerable(entrada, salida, None, self.control)
+        
+        entrada.close()
+        salida.close()
+        self.control.close()
+        with self.lock:
+            self.aviso.close()
+        self.context.term()
+    
+    def detener(self):
+        self.activo = False
+        with self.lock:
+            if not self.aviso.closed:
+                self.aviso.send(b"TERMINATE")
+
+class NodoFederado(threading.Thread):
+    """Replica los anuncios del chat y las sesiones de un Servidor en los demás nodos
+
+    Eventos por el broker: [FED:<tipo>, nodo de origen, datos...]
+      CHAT  sala (vacía = chat general), texto
+      ALTA  identidad, nombre
+      BAJA  identidad
+      VIVO  (cada `intervalo`; un nodo callado más de `plazo` se da por caído)
+    Los usuarios de otros nodos entran en la ListaUsuarios local con la clave
+    b"<nodo>/<identidad>", así /users los incluye. Al ver un nodo nuevo se le
+    reenvían las altas locales. Otros threads llaman a anuncio/alta/baja y los
+    eventos (y el aviso de detener) llegan al thread del nodo por inproc.
+    """
+    def __init__(self, servidor, id_nodo=None, broker="localhost",
+                 intervalo=INTERVALO_LATIDO, plazo=PLAZO_LATIDO, entrada=None, salida=None):
+        threading.Thread.__init__(self)
+        self.activo = True
+        self.daemon = True
+        self.servidor = servidor
+        self.id_nodo = (id_nodo or f"nodo-{random.randint(1000, 9999)}").encode()
+        # entrada/salida: endpoints del broker si no escucha en los puertos fijos de `broker`
+        self.entrada = entrada or f"tcp://{broker}:{BROKER_ENTRADA_PORT}"
+        self.salida = salida or f"tcp://{broker}:{BROKER_SALIDA_PORT}"
+        self.intervalo = intervalo
+        self.plazo = plazo
+        self.nodos = {}  # nodo -> instante de su último evento
+        self.remotos = {}  # nodo -> claves de sus usuarios en la ListaUsuarios
         
+        self.context = zmq.Context()
+        self.recepcion = self.context.socket(zmq.PULL)
+        self.recepcion.bind(f"inproc://federacion-{id(self)}")
+        self.envio = self.context.socket(zmq.PUSH)
+        self.envio.connect(f"inproc://federacion-{id(self)}")
+        self.lock = threading.Lock()
+    
+    def anuncio(self, anuncio):
+        sala, texto = anuncio if isinstance(anuncio, tuple) else ("", anuncio)
+        self._enviar([b"CHAT", sala.encode(), texto.encode()])
+    
+    def alta(self, identidad, nombre):
+        self._enviar([b"ALTA", identidad, nombre.encode()])
+    
+    def baja(self, identidad):
+        self._enviar([b"BAJA", identidad])
+    
+    def _enviar(self, frames):
+        with self.lock:
+            if self.envio is not None:
+                self.envio.send_multipart(frames)
+    
     def run(self):
-        context = zmq.Context()
-        socket = context.socket(zmq.ROUTER)  # ROUTER maneja múltiples clientes
-        socket.bind(f"tcp://*:{SERVIDOR_PORT}")
-        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        publicador = configurar_hwm(self.context.socket(zmq.PUB))
+        publicador.connect(self.entrada)
+        suscriptor = configurar_hwm(self.context.socket(zmq.SUB))
+        suscriptor.connect(self.salida)
+        suscriptor.setsockopt(zmq.SUBSCRIBE, b"FED:")
         
-        print("🟢 [SERVIDOR] Listo para múltiples clientes\n")
+        poller = zmq.Poller()
+        poller.register(suscriptor, zmq.POLLIN)
+        poller.register(self.recepcion, zmq.POLLIN)
+        print(f"🌐 [FEDERACIÓN] Nodo '{self.id_nodo.decode()}' conectado a {self.salida}\n")
         
+        proximo_vivo = 0
         while self.activo:
-            try:
-                # Recibir: [identidad_cliente, vacío, mensaje]
-                identidad = socket.recv()
-                socket.recv()  # frame vacío
-                mensaje = socket.recv_string()
-                
-                # Procesar comando
-                respuesta = self.procesar_comando(identidad, mensaje)
-                
-                # Enviar respuesta al cliente específico
-                socket.send(identidad, zmq.SNDMORE)
-                socket.send(b"", zmq.SNDMORE)
-                socket.send_string(respuesta)
-                
-                self.mensajes_procesados += 1
-                
-            except zmq.Again:
-                continue
-            except Exception as e:
-                print(f"❌ [SERVIDOR] Error: {e}")
+            ahora = time.monotonic()
+            if ahora >= proximo_vivo:
+                publicador.send_multipart([b"FED:VIVO", self.id_nodo])
+                self._caducar(ahora)
+                proximo_vivo = ahora + self.intervalo
+            
+            eventos = dict(poller.poll((proximo_vivo - ahora) * 1000))
+            if self.recepcion in eventos:
+                while True:
+                    try:
+                        frames = self.recepcion.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if frames == [b"FIN"]:
+                        break  # detener()
+                    publicador.send_multipart([b"FED:" + frames[0], self.id_nodo] + frames[1:])
+            if suscriptor in eventos:
+                while True:
+                    try:
+                        frames = suscriptor.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if len(frames) >= 2 and frames[1] != self.id_nodo:
+                        self._recibido(publicador, frames[0][4:], frames[1], frames[2:])
         
-        socket.close()
-        context.term()
+        with self.lock:
+            self.envio.close()
+            self.envio = None
+        self.recepcion.close()
+        publicador.close(linger=0)
+        suscriptor.close()
+        self.context.term()
     
-    def procesar_comando(self, identidad, comando):
-        """Procesa comandos de los clientes"""
-        id_corto = identidad.hex()[:8]
+    def _recibido(self, publicador, tipo, nodo, datos):
+        if nodo not in self.nodos:
+            print(f"🌐 [FEDERACIÓN] Nodo '{nodo.decode()}' se unió")
+            self.remotos[nodo] = set()
+            self._reenviar_altas(publicador)
+        self.nodos[nodo] = time.monotonic()
         
-        if comando.startswith("/login"):
-            partes = comando.split(maxsplit=1)
-            if len(partes) == 2:
-                nombre = partes[1].strip()
-                with self.lock:
-                    self.clientes_conectados[identidad] = nombre
-                
-                # Anunciar al chat
-                self.cola_chat.put(f"🎉 {nombre} se ha conectado!")
-                print(f"👤 [SERVIDOR] Cliente '{nombre}' conectado ({id_corto})")
-                return f"✅ Bienvenido {nombre}! Hay {len(self.clientes_conectados)} usuarios conectados"
-            return "❌ Usa: /login <tu_nombre>"
-        
-        elif comando.startswith("/msg"):
-            partes = comando.split(maxsplit=1)
-            if len(partes) == 2:
-                texto = partes[1].strip()
-                nombre = self.clientes_conectados.get(identidad, f"Usuario-{id_corto}")
-                
-                # Enviar mensaje al chat
-                self.cola_chat.put(f"💬 {nombre}: {texto}")
-                return "✅ Mensaje enviado al chat"
-            return "❌ Usa: /msg <texto>"
+        if tipo == b"CHAT" and len(datos) == 2:
+            sala, texto = datos[0].decode(), datos[1].decode()
+            self.servidor.cola_chat.put((sala, texto) if sala else texto)
+        elif tipo == b"ALTA" and len(datos) == 2:
+            clave = nodo + b"/" + datos[0]
+            with self.servidor.lock:
+                self.servidor.usuarios.alta(clave, datos[1].decode())
+            self.remotos[nodo].add(clave)
+        elif tipo == b"BAJA" and len(datos) == 1:
+            clave = nodo + b"/" + datos[0]
+            with self.servidor.lock:
+                self.servidor.usuarios.baja(clave)
+            self.remotos[nodo].discard(clave)
+    
+    def _reenviar_altas(self, publicador):
+        """Vuelve a anunciar los usuarios locales (para los nodos que acaban de llegar)"""
+        remotas = set().union(*self.remotos.values())
+        with self.servidor.lock:
+            locales = [(identidad, nombre) for identidad, nombre in self.servidor.clientes_conectados.items()
+                       if identidad not in remotas]
+        for identidad, nombre in locales:
+            publicador.send_multipart([b"FED:ALTA", self.id_nodo, identidad, nombre.encode()])
+    
+    def _caducar(self, ahora):
+        """Quita los usuarios de los nodos que dejaron de dar señales"""
+        for nodo, visto in list(self.nodos.items()):
+            if ahora - visto > self.plazo:
+                del self.nodos[nodo]
+                claves = self.remotos.pop(nodo, set())
+                with self.servidor.lock:
+                    for clave in claves:
+                        self.servidor.usuarios.baja(clave)
+                print(f"🌐 [FEDERACIÓN] Nodo '{nodo.decode()}' caído: {len(claves)} usuarios fuera")
+    
+    def detener(self):
+        self.activo = False
+        self._enviar([b"FIN"])
+
+class AnilloHash:
+    """Hash consistente: cada nodo ocupa `replicas` puntos de un anillo de 64 bits
+
+    Una identidad va siempre al mismo nodo, y añadir o quitar un nodo solo mueve
+    las identidades de los puntos afectados. Puntos y claves usan BLAKE2b, que
+    reparte bien identidades parecidas (crc32 las amontonaba en un nodo).
+    """
+    def __init__(self, nodos, replicas=REPLICAS_ANILLO):
+        puntos = sorted((self._hash(b"%s#%d" % (nodo, i)), nodo) for nodo in nodos for i in range(replicas))
+        self.claves = [punto for punto, _ in puntos]
+        self.nodos = [nodo for _, nodo in puntos]
+    
+    @staticmethod
+    def _hash(datos):
+        return int.from_bytes(hashlib.blake2b(datos, digest_size=8).digest(), "big")
+    
+    def nodo(self, clave):
+        indice = bisect.bisect(self.claves, self._hash(clave))
+        return self.nodos[indice % len(self.nodos)]
+
+class ColaRemota:
+    """Hace de cola del chat en un fragmento: los anuncios viajan al proceso frontal
+
+    qsize() es siempre 0: la saturación de la cola real la comprueba el
+    frontal (ServidorFragmentado) antes de repartir cada petición.
+    """
+    def __init__(self, context, endpoint):
+        self.socket = configurar_hwm(context.socket(zmq.PUSH))
+        self.socket.connect(endpoint)
+        self.lock = threading.Lock()
+    
+    def put(self, anuncio):
+        sala, texto = anuncio if isinstance(anuncio, tuple) else ("", anuncio)
+        with self.lock:
+            self.socket.send_multipart([sala.encode(), texto.encode()])
+    
+    def qsize(self):
+        return 0  # La cola real (y su saturación) está en el proceso frontal
+    
+    def close(self):
+        self.socket.close()
+
+class NodoFragmento(NodoFederado):
+    """Nodo que solo replica sesiones: el chat de todos los fragmentos ya lo reúne el frontal"""
+    def anuncio(self, anuncio):
+        pass
+
+def proceso_fragmento(indice, endpoint_trabajo, endpoint_anuncios, bus_entrada, bus_salida):
+    """Proceso de un fragmento: atiende en orden a las identidades que le asigna el frontal
+
+    bus_entrada y bus_salida son los endpoints del broker propio del frontal.
+    """
+    context = zmq.Context()
+    cola_chat = ColaRemota(context, endpoint_anuncios)
+    procesador = ProcesadorComandos(cola_chat)
+    nodo = NodoFragmento(procesador, f"fragmento-{indice}", entrada=bus_entrada, salida=bus_salida)
+    procesador.federacion = nodo
+    nodo.start()
+    
+    socket = configurar_hwm(context.socket(zmq.DEALER))
+    socket.setsockopt(zmq.IDENTITY, b"fragmento-%d" % indice)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(endpoint_trabajo)
+    socket.send(b"LISTO")
+    
+    while True:
+        frames = socket.recv_multipart()
+        if frames == [b"FIN"]:
+            break
+        try:
+            # [identidad_cliente, vacío, (id_peticion,) mensaje], igual que en Servidor
+            respuesta = procesador.atender(frames)
+            if respuesta:
+                socket.send_multipart(respuesta)
+        except Exception as e:
+            print(f"❌ [FRAGMENTO {indice}] Error: {e}")
+    
+    nodo.detener()
+    nodo.join()
+    socket.close()
+    cola_chat.close()
+    context.term()
+
+class ServidorFragmentado(ProcesadorComandos, threading.Thread):
+    """Frontal ROUTER que reparte los clientes entre procesos por hash de su identidad
+
+    Cada proceso (proceso_fragmento) tiene su ProcesadorComandos con las sesiones
+    de sus identidades, así el procesado de comandos usa varios núcleos. Una
+    identidad va siempre al mismo proceso y este atiende en orden, así se
+    conserva el orden de cada cliente. Los anuncios de todos llegan por PUSH/PULL
+    a la cola del chat de este proceso (un único ChatBroadcast), y las sesiones
+    se replican entre fragmentos con un BrokerFederacion propio, solo en
+    127.0.0.1 y en puertos libres, para que /users los vea todos. /historial se
+    atiende aquí, junto al historial del chat, y también aquí se rechazan los
+    comandos que publican cuando la cola del chat está saturada.
+    """
+    VERBOS_FRENTE = (b"/historial",)
+    
+    def __init__(self, cola_chat, num_fragmentos=NUM_FRAGMENTOS, registro=None, puerto=SERVIDOR_PORT):
+        threading.Thread.__init__(self)
+        ProcesadorComandos.__init__(self, cola_chat, registro)
+        self.activo = True
+        self.daemon = True
+        self.puerto = puerto
+        self.fragmentos = [b"fragmento-%d" % i for i in range(num_fragmentos)]
+        self.anillo = AnilloHash(self.fragmentos)
+        self.procesos = []
+        self.broker = BrokerFederacion(interfaz="tcp://127.0.0.1")
+        self.listo = threading.Event()
+        self.context = contexto_para(endpoint_bind(puerto))
+        self.despertador = Despertador(self.context)
+    
+    def run(self):
+        context = self.context
+        frente = configurar_hwm(context.socket(zmq.ROUTER))
+        frente.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        frente.bind(endpoint_bind(self.puerto))
+        trabajo = configurar_hwm(context.socket(zmq.ROUTER))
+        trabajo.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        puerto_trabajo = trabajo.bind_to_random_port("tcp://127.0.0.1")
+        anuncios = configurar_hwm(context.socket(zmq.PULL))
+        puerto_anuncios = anuncios.bind_to_random_port("tcp://127.0.0.1")
         
-        elif comando.startswith("/users"):
-            with self.lock:
-                if not self.clientes_conectados:
-                    return "📭 No hay usuarios conectados"
-                
-                lista = "\n".join([f"  👤 {nombre}" for nombre in self.clientes_conectados.values()])
-                return f"👥 Usuarios conectados ({len(self.clientes_conectados)}):\n{lista}"
+        self.broker.start()
+        self.broker.listo.wait()
+        contexto_procesos = multiprocessing.get_context("spawn")
+        for indice in range(len(self.fragmentos)):
+            proceso = contexto_procesos.Process(
+                target=proceso_fragmento, daemon=True,
+                args=(indice, f"tcp://127.0.0.1:{puerto_trabajo}", f"tcp://127.0.0.1:{puerto_anuncios}",
+                      self.broker.endpoint_entrada, self.broker.endpoint_salida))
+            proceso.start()
+            self.procesos.append(proceso)
         
-        elif comando.startswith("/suma"):
-            try:
-                partes = comando.split()
-                a, b = int(partes[1]), int(partes[2])
-                resultado = a + b
-                nombre = self.clientes_conectados.get(identidad, "Alguien")
-                self.cola_chat.put(f"🔢 {nombre} calculó: {a} + {b} = {resultado}")
-                return f"✅ Resultado: {resultado}"
-            except:
-                return "❌ Usa: /suma <num1> <num2>"
-        
-        elif comando.startswith("/hora"):
-            return f"🕐 Hora: {time.strftime('%H:%M:%S')}"
-        
-        elif comando.startswith("/stats"):
-            return f"📊 Mensajes: {self.mensajes_procesados} | Usuarios: {len(self.clientes_conectados)}"
-        
-        elif comando.startswith("/logout"):
-            nombre = self.clientes_conectados.get(identidad, "Usuario")
-            with self.lock:
-                if identidad in self.clientes_conectados:
-                    del self.clientes_conectados[identidad]
-            self.cola_chat.put(f"👋 {nombre} se ha desconectado")
-            return "✅ Hasta luego!"
+        # Hasta que todos los fragmentos se presenten no hay a quién repartir
+        poller = zmq.Poller()
+        poller.register(trabajo, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
+        listos = set()
+        while self.activo and len(listos) < len(self.fragmentos):
+            if trabajo in dict(poller.poll()):
+                listos.add(trabajo.recv_multipart()[0])
+        print(f"🟢 [SERVIDOR] Listo: {len(self.fragmentos)} procesos atienden a los clientes\n")
+        self.listo.set()
+        
+        for socket in (frente, anuncios):
+            poller.register(socket, zmq.POLLIN)
+        
+        while self.activo:
+            eventos = dict(poller.poll())
+            if frente in eventos:
+                self._repartir_peticiones(frente, trabajo)
+            if trabajo in eventos:
+                for _ in range(LOTE_SERVIDOR):
+                    try:
+                        frames = trabajo.recv_multipart(zmq.NOBLOCK)
+                        # [fragmento, identidad_cliente, ...]: se quita el fragmento
+                        frente.send_multipart(frames[1:], zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    except zmq.ZMQError:
+                        self.metricas.incrementar("respuestas_perdidas")
+            if anuncios in eventos:
+                for _ in range(LOTE_BROADCAST):
+                    try:
+                        sala, texto = anuncios.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    self.cola_chat.put((sala.decode(), texto.decode()) if sala else texto.decode())
         
+        for fragmento in self.fragmentos:
+            try:
+                trabajo.send_multipart([fragmento, b"FIN"], zmq.NOBLOCK)
+            except zmq.ZMQError:
+                pass
+        for proceso in self.procesos:
+            proceso.join(2)
+            if proceso.is_alive():
+                proceso.terminate()
+        self.broker.detener()
+        self.broker.join()
+        for socket in (frente, trabajo, anuncios):
+            socket.close(linger=0)
+        self.despertador.cerrar()
+        terminar_contexto(context)
+    
+    def _saturado(self, carga):
+        """Si la cola del chat está saturada y la petición publica (los fragmentos no ven la cola)"""
+        umbral = self.admision.umbral
+        if not umbral or self.cola_chat.qsize() < umbral:
+            return False
+        if carga[:1] == b"/":
+            entrada = self.comandos.get(carga.split(b" ", 1)[0].decode("utf-8", "replace"))
         else:
-            return "❓ Comando desconocido. Usa /ayuda"
+            entrada = self.operaciones.get(carga[1]) if len(carga) > 1 else None
+        return entrada is not None and entrada.publica and not entrada.esencial
+    
+    @staticmethod
+    def _rechazo_saturado(carga):
+        if carga[:1] == b"/":
+            return RECHAZOS["saturado"].encode()
+        version, codigo, id_peticion = CABECERA_PETICION.unpack_from(carga)
+        return (CABECERA_RESPUESTA.pack(VERSION_BINARIA, codigo, id_peticion, ESTADO_RECHAZADA)
+                + RECHAZOS["saturado"].encode())
+    
+    def _repartir_peticiones(self, frente, trabajo):
+        for _ in range(LOTE_SERVIDOR):
+            try:
+                frames = frente.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            try:
+                if len(frames) in (3, 4) and frames[-1].startswith(self.VERBOS_FRENTE):
+                    respuesta = self.atender(frames)
+                    if respuesta:
+                        frente.send_multipart(respuesta, zmq.NOBLOCK)
+                elif len(frames) in (3, 4) and self._saturado(frames[-1]):
+                    self.metricas.incrementar("rechazos_saturado")
+                    frente.send_multipart(frames[:-1] + [self._rechazo_saturado(frames[-1])], zmq.NOBLOCK)
+                else:
+                    trabajo.send_multipart([self.anillo.nodo(frames[0])] + frames, zmq.NOBLOCK)
+            except zmq.ZMQError:
+                self.metricas.incrementar("respuestas_perdidas")
     
     def detener(self):
         self.activo = False
+        self.despertador.despertar()
 
-class ChatBroadcast(threading.Thread):
-    """Difunde mensajes del chat a todos los clientes"""
-    def __init__(self, cola_chat):
-        threading.Thread.__init__(self)
-        self.cola_chat = cola_chat
+class SeguimientoChat:
+    """Estado del chat que sigue un cliente: sala, última secuencia y huecos
+
+    Al arrancar, al cambiar de sala o al ver un hueco pide al Servidor
+    (/historial) los mensajes que se perdió. Con identidad, cada hueco se
+    informa (/perdidos) y se aplica la política que responda el Servidor.
+    Cada mensaje se escribe con _escribir (por defecto, en la salida estándar).
+    
+    `suscrito` se activa cuando ChatBroadcast confirma la suscripción al tema.
+    """
+    def __init__(self, recuperar, identidad, endpoint, endpoint_servidor):
+        self.endpoint = endpoint
+        self.endpoint_servidor = endpoint_servidor
         self.activo = True
+        self.sala = None
+        self.recuperar = recuperar
+        self.identidad = identidad
+        self.ultima_seq = 0
+        self.suscrito = threading.Event()
+        self.confirmacion = None
+        self.informes = None  # DEALER de /traza, se crea en el thread del SUB
+        self.vistas = OrderedDict()  # tema -> última secuencia vista al salir de él
+    
+    def _suscribir(self, socket, tema):
+        """Se suscribe al tema y a un tema de confirmación propio (ver ChatBroadcast)"""
+        socket.setsockopt_string(zmq.SUBSCRIBE, tema)
+        self.suscrito.clear()
+        if self.confirmacion is not None:
+            socket.setsockopt_string(zmq.UNSUBSCRIBE, self.confirmacion)
+        self.confirmacion = f"{PREFIJO_CONFIRMACION}{random.getrandbits(64):016x}"
+        socket.setsockopt_string(zmq.SUBSCRIBE, self.confirmacion)
+    
+    def _cambiar_tema(self, socket, sala):
+        """Pasa el SUB a la sala (None = chat general); False si ya estaba en ella
+
+        Se recuerda la última secuencia vista de cada tema: al volver solo se
+        piden al historial los mensajes posteriores.
+        """
+        sala = sala or None
+        if sala == self.sala:
+            return False
+        anterior, tema = tema_sala(self.sala), tema_sala(sala)
+        socket.setsockopt_string(zmq.UNSUBSCRIBE, anterior)
+        self.vistas[anterior] = self.ultima_seq
+        if len(self.vistas) > MAX_TEMAS_HISTORIAL:
+            self.vistas.popitem(last=False)
+        self.sala = sala
+        self._suscribir(socket, tema)
+        self.ultima_seq = self.vistas.pop(tema, 0)
+        self._recuperar(inicial=not self.ultima_seq)
+        return True
+    
+    def _procesar(self, socket, frames, tema):
+        """Trata un mensaje del SUB (suelto o lote agrupado)"""
+        if len(frames) > 2 and frames[-1].startswith(PREFIJO_TRAZA.encode()):
+            self._informar_traza(frames.pop()[len(PREFIJO_TRAZA):].decode(), time.time_ns())
+        if frames[0].startswith(PREFIJO_CONFIRMACION.encode()):
+            if self.confirmacion is not None and frames[0].decode() == self.confirmacion:
+                socket.setsockopt_string(zmq.UNSUBSCRIBE, self.confirmacion)
+                self.confirmacion = None
+                self.suscrito.set()
+            return
+        if len(frames) == 3:
+            # Lote agrupado: [tema, secuencia del primero, textos]
+            primera = int(frames[1])
+            mensajes = [(contenido, primera + i)
+                        for i, contenido in enumerate(desempaquetar_lote(frames[2]))]
+        else:
+            # Remover el prefijo del tema ("CHAT:" o "SALA:<sala>:")
+            mensajes = [(frames[0].decode()[len(tema):],
+                         int(frames[1]) if len(frames) == 2 else None)]
+        for contenido, seq in mensajes:
+            if not self._recibido(contenido, seq):
+                break
+        else:
+            return
+        if self.activo:
+            # descartar_antiguo: lo encolado ya es viejo, se salta a lo último
+            self._vaciar(socket)
+            self.ultima_seq = 0
+            self._recuperar(inicial=True)
+    
+    def _recibido(self, contenido, seq):
+        """Muestra un mensaje del SUB salvo que sea repetido y trata los huecos
+
+        Devuelve False si hay que dejar de procesar lo recibido (el receptor
+        salta a lo más reciente o el Servidor lo desconectó).
+        """
+        if seq is not None:
+            if seq <= self.ultima_seq:
+                return True  # Ya llegó por el historial
+            if self.ultima_seq and seq > self.ultima_seq + 1:
+                perdidos = seq - self.ultima_seq - 1
+                politica = self._informar_perdidos(perdidos)
+                if politica == "recuperar":
+                    self._recuperar(hasta=seq)
+                elif politica == "descartar_nuevo":
+                    self._mostrar(f"⚠️ {perdidos} mensajes perdidos")
+                elif politica == "descartar_antiguo":
+                    return False
+                elif politica == "desconectar":
+                    self._mostrar("⛔ Desconectado: no sigues el ritmo del chat")
+                    self.activo = False
+                    return False
+            self.ultima_seq = seq
+        self._mostrar(contenido)
+        return True
+    
+    def _informar_perdidos(self, perdidos):
+        """Avisa al Servidor de un hueco y devuelve la política a aplicar"""
+        if self.identidad is None:
+            return "recuperar"
+        try:
+            sesion = obtener_sesion(self.identidad, self.endpoint_servidor)
+            politica = sesion.enviar_comando(f"/perdidos {perdidos}")
+        except zmq.Again:
+            return "recuperar"
+        return politica if politica in POLITICAS_LENTOS else "recuperar"
+    
+    def _informar_traza(self, id_traza, recibido):
+        """Avisa al Servidor de cuándo llegó un anuncio trazado (ver Trazador)
+
+        Sin esperar la respuesta, para no frenar al SUB: va por un DEALER propio
+        y las respuestas que haya acumuladas se descartan antes de cada envío.
+        """
+        if self.identidad is None:
+            return
+        if self.informes is None:
+            self.informes = self.context.socket(zmq.DEALER)
+            self.informes.setsockopt(zmq.LINGER, 0)
+            self.informes.connect(self.endpoint_servidor)
+        self._vaciar(self.informes)
+        try:
+            self.informes.send_multipart([b"", f"/traza {id_traza} {recibido}".encode()], zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+    
+    def _vaciar(self, socket):
+        """Descarta los mensajes que el SUB tenga encolados"""
+        while True:
+            try:
+                socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+    
+    def _recuperar(self, inicial=False, hasta=None):
+        """Pide al Servidor los mensajes del tema posteriores a ultima_seq
+
+        Al arrancar (inicial) solo los HISTORIAL_INICIAL más recientes; si no,
+        por páginas de MAX_RESPUESTA_HISTORIAL hasta ponerse al día.
+        """
+        if not self.recuperar:
+            return
+        socket = configurar_hwm(self.context.socket(zmq.DEALER))
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVTIMEO, 2000)
+        socket.connect(self.endpoint_servidor)
+        try:
+            while True:
+                antes = self.ultima_seq
+                desde = f"ultimos {HISTORIAL_INICIAL}" if inicial else antes
+                socket.send_multipart([b"", f"/historial json {desde} {self.sala or ''}".encode()])
+                mensajes = json.loads(socket.recv_multipart()[-1])
+                for seq, texto in mensajes:
+                    if seq > self.ultima_seq and (hasta is None or seq < hasta):
+                        self._mostrar(texto)
+                        self.ultima_seq = seq
+                if (inicial or len(mensajes) < MAX_RESPUESTA_HISTORIAL or self.ultima_seq == antes
+                        or (hasta is not None and self.ultima_seq >= hasta - 1)):
+                    return
+        except (zmq.Again, ValueError):
+            return  # Servidor sin historial o sin respuesta: se sigue sin recuperar
+        finally:
+            socket.close()
+    
+    def _mostrar(self, contenido):
+        if self.sala:
+            contenido = f"[#{self.sala}] {contenido}"
+        self._escribir(contenido)
+    
+    def _escribir(self, contenido):
+        print(contenido)
+
+class ClienteReceptor(SeguimientoChat, threading.Thread):
+    """Thread que escucha mensajes del chat general o de la sala actual"""
+    def __init__(self, recuperar=True, identidad=None, endpoint=f"tcp://localhost:{CHAT_PORT}",
+                 endpoint_servidor=f"tcp://localhost:{SERVIDOR_PORT}"):
+        threading.Thread.__init__(self)
+        SeguimientoChat.__init__(self, recuperar, identidad, endpoint, endpoint_servidor)
         self.daemon = True
         
+        # Los cambios de sala llegan al thread por inproc (el SUB no es thread-safe)
+        self.context = contexto_para(endpoint)
+        self.control = self.context.socket(zmq.PAIR)
+        self.control.bind(f"inproc://receptor-{id(self)}")
+        self.aviso = self.context.socket(zmq.PAIR)
+        self.aviso.connect(f"inproc://receptor-{id(self)}")
+        self.lock = threading.Lock()
+        self.despertador = Despertador(self.context)
+        
     def run(self):
-        context = zmq.Context()
-        socket = context.socket(zmq.PUB)
-        socket.bind(f"tcp://*:{CHAT_PORT}")
+        socket = configurar_hwm(self.context.socket(zmq.SUB))
+        socket.connect(self.endpoint)
+        tema = tema_sala(self.sala)
+        self._suscribir(socket, tema)
+        self._recuperar(inicial=True)
         
-        print("📻 [CHAT] Canal de difusión activo\n")
-        time.sleep(0.5)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.control, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
         
         while self.activo:
-            if not self.cola_chat.empty():
-                mensaje = self.cola_chat.get()
-                socket.send_string(f"CHAT:{mensaje}")
-                print(f"📢 {mensaje}")
-            time.sleep(0.1)
+            eventos = dict(poller.poll())
+            
+            if self.control in eventos:
+                # Cambiar la suscripción: el publicador deja de enviarnos la sala anterior
+                if self._cambiar_tema(socket, self.control.recv_string()):
+                    tema = tema_sala(self.sala)
+            
+            if socket in eventos:
+                self._procesar(socket, socket.recv_multipart(), tema)
         
-        socket.close()
-        context.term()
+        socket.close(linger=0)
+        if self.informes is not None:
+            self.informes.close()
+        self.control.close()
+        with self.lock:
+            self.aviso.close()
+        self.despertador.cerrar()
+        terminar_contexto(self.context)
+    
+    def _escribir(self, contenido):
+        print(f"\n{contenido}")
+        print("💻 Comando: ", end="", flush=True)
+    
+    def cambiar_sala(self, sala):
+        """Suscribirse a la sala indicada (None = chat general)"""
+        with self.lock:
+            if not self.aviso.closed:
+                self.aviso.send_string(sala or "")
     
     def detener(self):
         self.activo = False
+        self.despertador.despertar()
 
-class ClienteReceptor(threading.Thread):
-    """Thread que escucha mensajes del chat"""
-    def __init__(self):
+class LatidoCliente(threading.Thread):
+    """Envía latidos al servidor con la misma identidad que la sesión de comandos"""
+    def __init__(self, identidad, endpoint=f"tcp://localhost:{HEARTBEAT_PORT}", intervalo=INTERVALO_LATIDO):
         threading.Thread.__init__(self)
         self.activo = True
         self.daemon = True
-        
+        self.identidad = identidad
+        self.endpoint = endpoint
+        self.intervalo = intervalo
+        self.context = contexto_para(endpoint)
+        self.despertador = Despertador(self.context)
+    
     def run(self):
-        context = zmq.Context()
-        socket = context.socket(zmq.SUB)
-        socket.connect(f"tcp://localhost:{CHAT_PORT}")
-        socket.setsockopt_string(zmq.SUBSCRIBE, "CHAT:")
-        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        socket = configurar_hwm(self.context.socket(zmq.DEALER))
+        socket.setsockopt(zmq.IDENTITY, self.identidad)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
         
+        proximo = time.monotonic()
         while self.activo:
+            ahora = time.monotonic()
+            if ahora >= proximo:
+                try:
+                    socket.send(b"PING", zmq.NOBLOCK)
+                except zmq.Again:
+                    pass  # Servidor caído: la cola está llena, se reintenta en el siguiente
+                proximo = ahora + self.intervalo
+            # Esperar hasta el siguiente latido descartando los PONG
+            if socket in dict(poller.poll((proximo - ahora) * 1000)):
+                socket.recv()
+        
+        socket.close()
+        self.despertador.cerrar()
+        terminar_contexto(self.context)
+    
+    def detener(self):
+        self.activo = False
+        self.despertador.despertar()
+
+class SesionCliente:
+    """Conexión DEALER persistente con el servidor (un Context y un socket por sesión)"""
+    def __init__(self, identidad, endpoint=f"tcp://localhost:{SERVIDOR_PORT}", timeout=5000):
+        self.identidad = identidad
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.context = contexto_para(endpoint)
+        self.lock = threading.Lock()
+        self.socket = None
+        self._conectar()
+
+    def _conectar(self):
+        self.socket = configurar_hwm(self.context.socket(zmq.DEALER))
+        self.socket.setsockopt(zmq.IDENTITY, self.identidad)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVTIMEO, self.timeout)
+        self.socket.connect(self.endpoint)
+
+    def enviar_comando(self, comando):
+        """Envía un comando y devuelve la respuesta (lanza zmq.Again si no hay respuesta)"""
+        return self._intercambiar(comando.encode()).decode()
+
+    def _intercambiar(self, carga):
+        """Envía un frame y devuelve el frame de respuesta"""
+        with self.lock:
             try:
-                mensaje = socket.recv_string()
-                # Remover prefijo "CHAT:"
-                contenido = mensaje[5:]
-                print(f"\n{contenido}")
-                print("💻 Comando: ", end="", flush=True)
+                self.socket.send_multipart([b"", carga])
+                _, respuesta = self.socket.recv_multipart()
+                return respuesta
             except zmq.Again:
-                continue
+                # La respuesta puede llegar tarde: se cambia de socket para no confundirla
+                # con la del siguiente comando (ZMQ reconecta solo por debajo)
+                self.socket.close()
+                self._conectar()
+                raise
+
+    def cerrar(self):
+        with self.lock:
+            self.socket.close()
+            terminar_contexto(self.context)
+
+class SesionBinaria(SesionCliente):
+    """Sesión que habla el protocolo binario: cuerpos tipados en vez de texto
+
+    Negocia "/proto binario" antes de la primera petición (y de nuevo tras un
+    logout, que lo anula en el servidor). Las respuestas con error lanzan ValueError.
+    """
+    def __init__(self, identidad, endpoint=f"tcp://localhost:{SERVIDOR_PORT}", timeout=5000):
+        SesionCliente.__init__(self, identidad, endpoint, timeout)
+        self.negociado = False
+        self.ids = itertools.count(1)
+
+    def peticion(self, codigo, cuerpo=b""):
+        """Envía una operación y devuelve el cuerpo de la respuesta"""
+        if not self.negociado:
+            respuesta = self.enviar_comando(f"/proto binario {VERSION_BINARIA}")
+            if not respuesta.startswith("✅"):
+                raise ValueError(respuesta)
+            self.negociado = True
+        id_peticion = next(self.ids) & 0xFFFFFFFF
+        respuesta = self._intercambiar(CABECERA_PETICION.pack(VERSION_BINARIA, codigo, id_peticion) + cuerpo)
+        try:
+            version, _, id_respuesta, estado = CABECERA_RESPUESTA.unpack_from(respuesta)
+        except struct.error:
+            raise ValueError(respuesta.decode("utf-8", "replace"))
+        if version != VERSION_BINARIA or id_respuesta != id_peticion:
+            self.negociado = False
+            raise ValueError(f"Respuesta inesperada: {respuesta!r}")
+        cuerpo = respuesta[CABECERA_RESPUESTA.size:]
+        if estado == ESTADO_DESCONOCIDA:
+            raise ValueError(f"Operación desconocida: {codigo}")
+        # ESTADO_ERROR y ESTADO_RECHAZADA traen el motivo en el cuerpo
+        if estado != ESTADO_OK:
+            raise ValueError(cuerpo.decode())
+        return cuerpo
+
+    def login(self, nombre):
+        """Devuelve cuántos usuarios hay conectados"""
+        return ENTERO.unpack(self.peticion(OP_LOGIN, nombre.encode()))[0]
+
+    def msg(self, texto):
+        self.peticion(OP_MSG, texto.encode())
+
+    def users(self):
+        cuerpo = self.peticion(OP_USERS)
+        return cuerpo.decode().split("\0") if cuerpo else []
+
+    def suma(self, a, b):
+        return ENTERO.unpack(self.peticion(OP_SUMA, DOS_ENTEROS.pack(a, b)))[0]
+
+    def hora(self):
+        return REAL.unpack(self.peticion(OP_HORA))[0]
+
+    def stats(self):
+        """(peticiones atendidas, usuarios conectados)"""
+        return DOS_ENTEROS.unpack(self.peticion(OP_STATS))
+
+    def join(self, sala):
+        self.peticion(OP_JOIN, sala.encode())
+
+    def leave(self):
+        self.peticion(OP_LEAVE)
+
+    def logout(self):
+        self.peticion(OP_LOGOUT)
+        self.negociado = False
+
+# Sesiones reutilizadas por enviar_comando_cliente: (identidad, servidor) -> SesionCliente
+_sesiones = {}
+_sesiones_lock = threading.Lock()
+
+def obtener_sesion(identidad_cliente, endpoint=f"tcp://localhost:{SERVIDOR_PORT}"):
+    """Devuelve la sesión persistente de esa identidad/servidor (la crea si no existe)"""
+    clave = (identidad_cliente, endpoint)
+    with _sesiones_lock:
+        sesion = _sesiones.get(clave)
+        if sesion is None:
+            sesion = _sesiones[clave] = SesionCliente(identidad_cliente, endpoint)
+        return sesion
+
+def cerrar_sesiones():
+    """Cierra todas las sesiones abiertas por enviar_comando_cliente"""
+    with _sesiones_lock:
+        for sesion in _sesiones.values():
+            sesion.cerrar()
+        _sesiones.clear()
+
+class ClientePipeline(threading.Thread):
+    """Cliente asíncrono: muchos comandos en vuelo sobre un único DEALER
+
+    Cada petición lleva un frame con su id de correlación que el Servidor devuelve
+    en la respuesta, así las respuestas se asocian a su Future aunque lleguen
+    en cualquier orden.
+    """
+    def __init__(self, identidad, endpoint=f"tcp://localhost:{SERVIDOR_PORT}",
+                 max_en_vuelo=1000, timeout=5.0):
+        threading.Thread.__init__(self)
+        self.activo = True
+        self.daemon = True
+        self.identidad = identidad
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.pendientes = {}  # id_peticion -> (Future, instante límite)
+        self.lock = threading.Lock()
+        self.cupos = threading.BoundedSemaphore(max_en_vuelo)
+        self.ids = itertools.count(1)
+        
+        # Los comandos pasan del thread llamador al thread de red por inproc
+        self.context = contexto_para(endpoint)
+        self.entrada = self.context.socket(zmq.PULL)
+        self.entrada.bind(f"inproc://pipeline-{id(self)}")
+        self.envio = self.context.socket(zmq.PUSH)
+        self.envio.connect(f"inproc://pipeline-{id(self)}")
+        self.despertador = Despertador(self.context)
+    
+    def enviar(self, comando, callback=None):
+        """Envía un comando sin esperar la respuesta y devuelve su Future
+
+        Si se indica, callback(futuro) se llama al llegar la respuesta. Bloquea
+        solo cuando ya hay max_en_vuelo comandos sin responder. Sin respuesta a
+        tiempo el Future falla con TimeoutError; cancelarlo libera su cupo.
+        """
+        self.cupos.acquire()
+        futuro = Future()
+        futuro.add_done_callback(lambda _: self.cupos.release())
+        if callback:
+            futuro.add_done_callback(callback)
+        
+        with self.lock:
+            if self.envio is None:
+                futuro.set_exception(RuntimeError("El cliente pipeline está detenido"))
+                return futuro
+            id_peticion = struct.pack("!Q", next(self.ids))
+            self.pendientes[id_peticion] = (futuro, time.monotonic() + self.timeout)
+            self.envio.send_multipart([id_peticion, comando.encode()])
+        return futuro
+    
+    def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.DEALER))
+        socket.setsockopt(zmq.IDENTITY, self.identidad)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.endpoint)
+        
+        poller = zmq.Poller()
+        poller.register(self.entrada, zmq.POLLIN)
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.despertador.socket, zmq.POLLIN)
+        
+        while self.activo:
+            # Despertar al menos cada segundo para caducar las peticiones vencidas
+            eventos = dict(poller.poll(1000))
+            
+            # Reenviar al servidor todo lo que encolaron los llamadores
+            if self.entrada in eventos:
+                while True:
+                    try:
+                        id_peticion, comando = self.entrada.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    socket.send_multipart([b"", id_peticion, comando])
+            
+            # Resolver los Futures de las respuestas: [vacío, id_peticion, respuesta]
+            if socket in eventos:
+                while True:
+                    try:
+                        frames = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if len(frames) != 3:
+                        continue
+                    with self.lock:
+                        pendiente = self.pendientes.pop(frames[1], None)
+                    if pendiente:
+                        self._resolver(pendiente[0], resultado=frames[2].decode())
+            
+            self._expirar(time.monotonic())
         
+        with self.lock:
+            self.envio.close()
+            self.envio = None
+            pendientes = list(self.pendientes.values())
+            self.pendientes.clear()
+        for futuro, _ in pendientes:
+            futuro.cancel()
+        self.entrada.close()
         socket.close()
-        context.term()
+        self.despertador.cerrar()
+        terminar_contexto(self.context)
+    
+    def _expirar(self, ahora):
+        """Falla los Futures sin respuesta a tiempo (están en orden de envío)"""
+        vencidos = []
+        with self.lock:
+            for id_peticion, (futuro, limite) in self.pendientes.items():
+                if limite > ahora:
+                    break
+                vencidos.append(id_peticion)
+            vencidos = [self.pendientes.pop(id_peticion)[0] for id_peticion in vencidos]
+        for futuro in vencidos:
+            self._resolver(futuro, error=TimeoutError("El servidor no respondió a tiempo"))
+    
+    @staticmethod
+    def _resolver(futuro, resultado=None, error=None):
+        """Completa el Future salvo que el llamador ya lo cancelara"""
+        try:
+            if not futuro.set_running_or_notify_cancel():
+                return
+            if error is not None:
+                futuro.set_exception(error)
+            else:
+                futuro.set_result(resultado)
+        except InvalidStateError:
+            pass  # Se completó por otro camino: no debe tumbar el thread de red
     
     def detener(self):
         self.activo = False
+        self.despertador.despertar()
 
-def enviar_comando_cliente(comando, identidad_cliente):
-    """Envía un comando al servidor usando DEALER (múltiples requests)"""
-    context = zmq.Context()
-    socket = context.socket(zmq.DEALER)
-    socket.setsockopt(zmq.IDENTITY, identidad_cliente)
-    socket.connect(f"tcp://localhost:{SERVIDOR_PORT}")
-    socket.setsockopt(zmq.RCVTIMEO, 5000)
+class ClienteInteractivo(SeguimientoChat):
+    """Cliente de terminal en un único bucle: stdin, comandos, chat y latidos
+
+    Un zmq.Poller espera a la vez sobre stdin, el DEALER de comandos, el SUB
+    del chat y el DEALER de latidos, así que un cliente inactivo solo despierta
+    para latir. Lo que llega en cada vuelta se escribe de una vez, y los
+    comandos llevan id de correlación: una respuesta tardía no se confunde con
+    la del siguiente.
+    """
+    def __init__(self, identidad, endpoint=f"tcp://localhost:{CHAT_PORT}",
+                 endpoint_servidor=f"tcp://localhost:{SERVIDOR_PORT}",
+                 endpoint_latidos=f"tcp://localhost:{HEARTBEAT_PORT}",
+                 intervalo=INTERVALO_LATIDO, timeout=5.0, entrada=None):
+        SeguimientoChat.__init__(self, True, identidad, endpoint, endpoint_servidor)
+        self.endpoint_latidos = endpoint_latidos
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self.entrada = sys.stdin.fileno() if entrada is None else entrada
+        self.context = contexto_para(endpoint, endpoint_servidor, endpoint_latidos)
+        self.ids = itertools.count(1)
+        self.pendientes = {}  # id_peticion -> (comando, instante límite), en orden de envío
+        self.salida = []
+        self.prompt = False
+        self.resto = b""
+        self.saliendo = False
     
-    try:
-        # Enviar comando
-        socket.send(b"", zmq.SNDMORE)
-        socket.send_string(comando)
+    def ejecutar(self):
+        """Atiende la terminal hasta /salir (o fin de la entrada)"""
+        self.comandos = self._dealer(self.endpoint_servidor)
+        latidos = self._dealer(self.endpoint_latidos)
+        self.chat = configurar_hwm(self.context.socket(zmq.SUB))
+        self.chat.setsockopt(zmq.LINGER, 0)
+        self.chat.connect(self.endpoint)
+        self.tema = tema_sala(self.sala)
+        self._suscribir(self.chat, self.tema)
         
-        # Recibir respuesta
-        socket.recv()  # frame vacío
-        respuesta = socket.recv_string()
-        print(f"\n{respuesta}")
+        self.poller = zmq.Poller()
+        for socket in (self.entrada, self.comandos, self.chat, latidos):
+            self.poller.register(socket, zmq.POLLIN)
+        
+        try:
+            self._recuperar(inicial=True)
+            self._volcar(prompt=False)
+            mostrar_menu()
+            self.prompt = True
+            proximo_latido = time.monotonic()
+            while not (self.saliendo and not self.pendientes):
+                ahora = time.monotonic()
+                if ahora >= proximo_latido:
+                    try:
+                        latidos.send(b"PING", zmq.NOBLOCK)
+                    except zmq.Again:
+                        pass  # Servidor caído: se reintenta en el siguiente
+                    proximo_latido = ahora + self.intervalo
+                
+                # Dormir hasta el próximo latido o el primer comando que caduque
+                limite = proximo_latido
+                if self.pendientes:
+                    limite = min(limite, next(iter(self.pendientes.values()))[1])
+                eventos = dict(self.poller.poll(max(0, limite - ahora) * 1000))
+                
+                if self.chat in eventos:
+                    self._leer_chat()
+                if self.comandos in eventos:
+                    self._leer_respuestas()
+                if latidos in eventos:
+                    self._vaciar(latidos)
+                if self.entrada in eventos:
+                    self._leer_entrada()
+                self._expirar(time.monotonic())
+                self._volcar()
+        finally:
+            self._volcar(prompt=False)
+            self.comandos.close()
+            latidos.close()
+            self.chat.close()
+            terminar_contexto(self.context)
+    
+    def _dealer(self, endpoint):
+        socket = configurar_hwm(self.context.socket(zmq.DEALER))
+        socket.setsockopt(zmq.IDENTITY, self.identidad)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(endpoint)
+        return socket
+    
+    def _leer_chat(self):
+        """Procesa lo que haya en el SUB, hasta un lote por vuelta"""
+        for _ in range(LOTE_BROADCAST):
+            try:
+                frames = self.chat.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._procesar(self.chat, frames, self.tema)
+            if not self.activo:
+                # Política "desconectar": se deja el chat pero siguen los comandos
+                self.poller.unregister(self.chat)
+                return
+    
+    def _leer_respuestas(self):
+        while True:
+            try:
+                frames = self.comandos.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._respuesta(frames)
+    
+    def _respuesta(self, frames):
+        """[vacío, id_peticion, respuesta]; las que ya caducaron se ignoran"""
+        pendiente = self.pendientes.pop(frames[1], None) if len(frames) == 3 else None
+        if pendiente is None:
+            return
+        comando, respuesta = pendiente[0], frames[2].decode()
+        self.salida.append(respuesta)
+        
+        # Al cambiar de sala, cambia la suscripción del SUB
+        if respuesta.startswith("✅"):
+            verbo, _, sala = comando.partition(" ")
+            if verbo == "/join":
+                self._cambiar_sala(sala.strip())
+            elif verbo in ("/leave", "/logout"):
+                self._cambiar_sala(None)
+    
+    def _leer_entrada(self):
+        """Lee de stdin sin bloquear y ejecuta cada línea completa"""
+        datos = os.read(self.entrada, 4096)
+        if not datos:
+            datos = b"\n/salir\n"  # Fin de la entrada (Ctrl+D)
+        *lineas, self.resto = (self.resto + datos).split(b"\n")
+        for linea in lineas:
+            if not self.saliendo:
+                self._comando(linea.decode("utf-8", "replace").strip())
+    
+    def _comando(self, comando):
+        if not comando:
+            self.prompt = True
+            return
+        
+        if comando == "/salir":
+            self._enviar("/logout")
+            self.salida.append("👋 Cerrando cliente...")
+            self.poller.unregister(self.entrada)
+            self.saliendo = True
+            return
+        
+        if comando == "/ayuda":
+            self._volcar(prompt=False)
+            mostrar_menu()
+            self.prompt = True
+            return
         
+        self._enviar(comando)
+    
+    def _enviar(self, comando, pendiente=True):
+        id_peticion = struct.pack("!Q", next(self.ids))
+        if pendiente:
+            self.pendientes[id_peticion] = (comando, time.monotonic() + self.timeout)
+        self.comandos.send_multipart([b"", id_peticion, comando.encode()])
+        return id_peticion
+    
+    def _expirar(self, ahora):
+        for id_peticion, (_, limite) in list(self.pendientes.items()):
+            if limite > ahora:
+                break
+            del self.pendientes[id_peticion]
+            self.salida.append("⏱️ Timeout: El servidor no respondió")
+    
+    def _informar_perdidos(self, perdidos):
+        """Como en SeguimientoChat, pero por el DEALER de comandos del bucle"""
+        id_peticion = self._enviar(f"/perdidos {perdidos}", pendiente=False)
+        limite = time.monotonic() + self.timeout
+        while self.comandos.poll(max(0, limite - time.monotonic()) * 1000):
+            frames = self.comandos.recv_multipart()
+            if len(frames) == 3 and frames[1] == id_peticion:
+                politica = frames[2].decode()
+                return politica if politica in POLITICAS_LENTOS else "recuperar"
+            self._respuesta(frames)
+        return "recuperar"
+    
+    def _informar_traza(self, id_traza, recibido):
+        """Como en SeguimientoChat, sin esperar la respuesta"""
+        self._enviar(f"/traza {id_traza} {recibido}", pendiente=False)
+    
+    def _cambiar_sala(self, sala):
+        if self._cambiar_tema(self.chat, sala):
+            self.tema = tema_sala(self.sala)
+    
+    def _escribir(self, contenido):
+        self.salida.append(contenido)
+    
+    def _volcar(self, prompt=True):
+        """Escribe de una vez lo acumulado en esta vuelta del bucle"""
+        if self.salida:
+            sys.stdout.write("\n" + "\n".join(self.salida) + "\n")
+            self.salida.clear()
+            self.prompt = True
+        if prompt and self.prompt and not self.saliendo:
+            sys.stdout.write("💻 Comando: ")
+            self.prompt = False
+        sys.stdout.flush()
+
+def enviar_comando_cliente(comando, identidad_cliente, endpoint=f"tcp://localhost:{SERVIDOR_PORT}"):
+    """Envía un comando al servidor reutilizando la sesión DEALER de esa identidad"""
+    try:
+        respuesta = obtener_sesion(identidad_cliente, endpoint).enviar_comando(comando)
+        print(f"\n{respuesta}")
+        return respuesta
     except zmq.Again:
         print("\n⏱️ Timeout: El servidor no respondió")
     except Exception as e:
         print(f"\n❌ Error: {e}")
-    finally:
-        socket.close()
-        context.term()
 
 def mostrar_menu():
     """Muestra el menú de comandos"""
@@ -213,28 +3203,107 @@ def mostrar_menu():
     print("="*60)
     print("  /login <nombre>      - Identificarte en el chat")
     print("  /msg <texto>         - Enviar mensaje al chat público")
-    print("  /users               - Ver usuarios conectados")
+    print("  /users [página]      - Ver usuarios conectados")
     print("  /suma <n1> <n2>      - Sumar números (todos lo ven)")
+    print("  /suma <v1,..> <w1,..> - Sumar vectores elemento a elemento")
+    print("  /trabajos            - Ver tus trabajos pendientes")
     print("  /hora                - Ver hora actual")
     print("  /stats               - Estadísticas del servidor")
+    print("  /join <sala>         - Entrar en una sala (solo ves su chat)")
+    print("  /leave               - Volver al chat general")
+    print("  /historial [desde]   - Ver los últimos mensajes del chat")
     print("  /logout              - Desconectarse")
     print("  /ayuda               - Mostrar este menú")
     print("  /salir               - Salir del programa")
     print("="*60 + "\n")
 
-def modo_servidor():
-    """Ejecuta el servidor"""
+def iniciar_servidor(broker=None, desplazamiento=0, fragmentos=0, servidor=SERVIDOR_PORT,
+                     chat=CHAT_PORT, latidos=HEARTBEAT_PORT, metricas=METRICAS_PORT,
+                     trazas=MUESTREO_TRAZAS, fichero_trazas=FICHERO_TRAZAS,
+                     directorio_registro=DIRECTORIO_REGISTRO):
+    """Arranca los componentes del servidor y devuelve (hilos, registro)
+
+    servidor, chat, latidos y metricas son puertos TCP o endpoints completos
+    (ipc://, inproc://...); desplazamiento solo se suma a los puertos. Con
+    trazas > 0 se traza esa fracción de los anuncios del chat (ver Trazador).
+    Con directorio_registro, lo difundido se guarda allí (ver RegistroChat).
+    """
+    def puerto(base):
+        return str(int(base) + desplazamiento) if base.isdigit() else base
+    
+    cola_chat = ColaChat()
+    registro = None
+    if directorio_registro:
+        registro = RegistroChat(directorio_registro)
+    
+    if fragmentos:
+        nucleo = ServidorFragmentado(cola_chat, fragmentos, registro, puerto(servidor))
+    else:
+        nucleo = Servidor(cola_chat, NUM_TRABAJADORES, registro, puerto(servidor))
+    if trazas > 0:
+        if fragmentos:
+            # Los anuncios se generan en los procesos de los fragmentos
+            print("⚠️ Las trazas no están disponibles con fragmentos")
+        else:
+            nucleo.trazador = Trazador(trazas, fichero_trazas)
+    chat_broadcast = ChatBroadcast(cola_chat, nucleo.metricas, nucleo.historial,
+                                   registro=registro, puerto=puerto(chat))
+    # Las sesiones de un ServidorFragmentado viven en sus procesos: sin caducidad por latidos
+    servicio_latidos = None if fragmentos else ServicioLatidos(nucleo, puerto=puerto(latidos))
+    publicador_metricas = PublicadorMetricas(nucleo, puerto=puerto(metricas))
+    nodo = None
+    if broker:
+        nodo = NodoFederado(nucleo, broker=broker)
+        nucleo.federacion = nodo
+        nodo.start()
+    if registro is not None:
+        registro.metricas = nucleo.metricas
+        registro.start()
+    
+    hilos = [nucleo, chat_broadcast, publicador_metricas]
+    if servicio_latidos is not None:
+        hilos.append(servicio_latidos)
+    for hilo in hilos:
+        hilo.start()
+    # Los fragmentos de un ServidorFragmentado tardan lo que tarde en arrancar un proceso
+    if not esperar_listos(*hilos, timeout=30 if fragmentos else 5):
+        print("⚠️ Algún componente no terminó de arrancar")
+    if nodo is not None:
+        hilos.append(nodo)
+    return hilos, registro
+
+def detener_servidor(hilos, registro):
+    """Detiene lo que arrancó iniciar_servidor"""
+    for hilo in hilos:
+        hilo.detener()
+    for hilo in hilos:
+        hilo.join()
+    if registro is not None:
+        # Después del broadcast: el registro escribe lo que quede pendiente y se cierra
+        registro.detener()
+        registro.join()
+        registro.cerrar()
+    trazador = hilos[0].trazador
+    if trazador is not None:
+        trazador.guardar()
+        print(f"🔎 Trazas guardadas en {trazador.fichero}")
+
+def modo_servidor(broker=None, desplazamiento=0, fragmentos=0, servidor=SERVIDOR_PORT,
+                  chat=CHAT_PORT, latidos=HEARTBEAT_PORT, metricas=METRICAS_PORT,
+                  trazas=MUESTREO_TRAZAS, fichero_trazas=FICHERO_TRAZAS,
+                  directorio_registro=DIRECTORIO_REGISTRO):
+    """Ejecuta el servidor
+
+    Con broker, el servidor es un nodo federado más; desplazamiento suma a todos
+    sus puertos (para varios nodos en la misma máquina). Con fragmentos > 0 los
+    comandos se procesan en ese número de procesos (ServidorFragmentado).
+    """
     print("\n" + "="*60)
     print("🖥️  MODO SERVIDOR - Sistema Multi-Cliente")
     print("="*60 + "\n")
     
-    cola_chat = Queue()
-    
-    servidor = Servidor(cola_chat)
-    chat_broadcast = ChatBroadcast(cola_chat)
-    
-    servidor.start()
-    chat_broadcast.start()
+    hilos, registro = iniciar_servidor(broker, desplazamiento, fragmentos, servidor, chat,
+                                       latidos, metricas, trazas, fichero_trazas, directorio_registro)
     
     print("✅ Servidor iniciado. Los clientes pueden conectarse ahora.")
     print("   Presiona Ctrl+C para detener\n")
@@ -244,13 +3313,45 @@ def modo_servidor():
             time.sleep(1)
     except KeyboardInterrupt:
         print("\n\n🛑 Deteniendo servidor...")
-        servidor.detener()
-        chat_broadcast.detener()
-        time.sleep(1)
+        detener_servidor(hilos, registro)
         print("✅ Servidor detenido\n")
 
-def modo_cliente():
-    """Ejecuta un cliente"""
+def modo_local(trazas=MUESTREO_TRAZAS, fichero_trazas=FICHERO_TRAZAS, directorio_registro=DIRECTORIO_REGISTRO):
+    """Servidor y cliente en el mismo proceso, comunicados por inproc://"""
+    hilos, registro = iniciar_servidor(servidor="inproc://servidor", chat="inproc://chat",
+                                       latidos="inproc://latidos", metricas="inproc://metricas",
+                                       trazas=trazas, fichero_trazas=fichero_trazas,
+                                       directorio_registro=directorio_registro)
+    try:
+        modo_cliente("inproc://servidor", "inproc://chat", "inproc://latidos")
+    finally:
+        detener_servidor(hilos, registro)
+
+def modo_broker():
+    """Ejecuta el broker que une a los nodos federados"""
+    print("\n" + "="*60)
+    print("🛰️  MODO BROKER - Federación de servidores")
+    print("="*60 + "\n")
+    
+    broker = BrokerFederacion()
+    broker.start()
+    print("   Presiona Ctrl+C para detener\n")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.detener()
+        broker.join()
+        print("\n✅ Broker detenido\n")
+
+def modo_cliente(servidor=SERVIDOR_PORT, chat=CHAT_PORT, latidos=HEARTBEAT_PORT, host="localhost"):
+    """Ejecuta un cliente
+
+    servidor, chat y latidos son puertos (en host) o endpoints completos.
+    """
+    servidor = endpoint_conexion(servidor, host)
+    chat = endpoint_conexion(chat, host)
+    latidos = endpoint_conexion(latidos, host)
     # Generar identidad única para este cliente
     identidad = f"cliente-{random.randint(1000, 9999)}".encode()
     
@@ -259,11 +3360,27 @@ def modo_cliente():
     print("="*60 + "\n")
     print("💡 Primero usa /login <tu_nombre> para identificarte\n")
     
+    try:
+        if os.name == "nt":
+            # En Windows zmq.Poller no puede esperar sobre stdin
+            cliente_con_hilos(identidad, servidor, chat, latidos)
+        else:
+            ClienteInteractivo(identidad, chat, servidor, latidos).ejecutar()
+    except KeyboardInterrupt:
+        print("\n\n⚠️ Interrupción detectada")
+    print("✅ Cliente desconectado\n")
+
+def cliente_con_hilos(identidad, servidor=f"tcp://localhost:{SERVIDOR_PORT}",
+                      chat=f"tcp://localhost:{CHAT_PORT}", latidos=f"tcp://localhost:{HEARTBEAT_PORT}"):
+    """Cliente con input() bloqueante y threads para el chat y los latidos"""
     # Iniciar thread que escucha el chat
-    receptor = ClienteReceptor()
+    receptor = ClienteReceptor(identidad=identidad, endpoint=chat, endpoint_servidor=servidor)
     receptor.start()
+    latido = LatidoCliente(identidad, latidos)
+    latido.start()
     
-    time.sleep(0.5)
+    # El menú sale cuando ChatBroadcast confirma la suscripción (o el servidor no responde)
+    receptor.suscrito.wait(2)
     mostrar_menu()
     
     try:
@@ -274,7 +3391,7 @@ def modo_cliente():
                 continue
             
             if comando == "/salir":
-                enviar_comando_cliente("/logout", identidad)
+                enviar_comando_cliente("/logout", identidad, servidor)
                 print("\n👋 Cerrando cliente...")
                 break
             
@@ -282,30 +3399,104 @@ def modo_cliente():
                 mostrar_menu()
                 continue
             
-            enviar_comando_cliente(comando, identidad)
+            respuesta = enviar_comando_cliente(comando, identidad, servidor)
             
-    except KeyboardInterrupt:
-        print("\n\n⚠️ Interrupción detectada")
+            # Al cambiar de sala, el receptor cambia su suscripción
+            if respuesta and respuesta.startswith("✅"):
+                verbo, _, sala = comando.partition(" ")
+                if verbo == "/join":
+                    receptor.cambiar_sala(sala.strip())
+                elif verbo in ("/leave", "/logout"):
+                    receptor.cambiar_sala(None)
     finally:
         receptor.detener()
-        time.sleep(0.5)
-        print("✅ Cliente desconectado\n")
+        latido.detener()
+        receptor.join()
+        latido.join()
+        cerrar_sesiones()
+
+def leer_argumentos(argv=None):
+    """Modo y endpoints desde la línea de comandos; PYZMQ_* en el entorno dan los valores por defecto
+
+    Cada endpoint es un puerto TCP ("5555") o uno completo: "ipc:///tmp/chat"
+    para clientes en la misma máquina, "tcp://eth0:5555"...
+    """
+    entorno = os.environ.get
+    parser = argparse.ArgumentParser(description="Sistema multi-cliente con PyZMQ")
+    parser.add_argument("modo", nargs="?",
+                        choices=("servidor", "cliente", "broker", "federado", "fragmentado", "local"),
+                        help="sin modo se muestra el menú interactivo")
+    parser.add_argument("--servidor", default=entorno("PYZMQ_SERVIDOR", SERVIDOR_PORT),
+                        help="endpoint de comandos (ROUTER)")
+    parser.add_argument("--chat", default=entorno("PYZMQ_CHAT", CHAT_PORT),
+                        help="endpoint del chat (PUB)")
+    parser.add_argument("--latidos", default=entorno("PYZMQ_LATIDOS", HEARTBEAT_PORT),
+                        help="endpoint de latidos")
+    parser.add_argument("--metricas", default=entorno("PYZMQ_METRICAS", METRICAS_PORT),
+                        help="endpoint de métricas")
+    parser.add_argument("--host", default=entorno("PYZMQ_HOST", "localhost"),
+                        help="host al que se conecta el cliente cuando un endpoint es solo un puerto")
+    parser.add_argument("--broker", default=entorno("PYZMQ_BROKER", "localhost"),
+                        help="IP del broker (modo federado)")
+    parser.add_argument("--desplazamiento", type=int, default=0,
+                        help="se suma a los puertos del nodo (modo federado)")
+    parser.add_argument("--fragmentos", type=int, default=NUM_FRAGMENTOS,
+                        help="procesos del modo fragmentado")
+    parser.add_argument("--trazas", type=float, default=float(entorno("PYZMQ_TRAZAS", MUESTREO_TRAZAS)),
+                        help="fracción de anuncios del chat que se trazan (0 = ninguno)")
+    parser.add_argument("--fichero-trazas", default=entorno("PYZMQ_FICHERO_TRAZAS", FICHERO_TRAZAS),
+                        help="fichero Chrome trace-event donde se guardan las trazas")
+    parser.add_argument("--registro", default=entorno("PYZMQ_REGISTRO", DIRECTORIO_REGISTRO),
+                        help="directorio del registro persistente del chat (sin él, solo en memoria)")
+    return parser.parse_args(argv)
 
 def main():
+    args = leer_argumentos()
+    endpoints = dict(servidor=args.servidor, chat=args.chat, latidos=args.latidos)
+    opciones = dict(trazas=args.trazas, fichero_trazas=args.fichero_trazas, directorio_registro=args.registro)
+    if args.modo == "servidor":
+        return modo_servidor(metricas=args.metricas, **endpoints, **opciones)
+    if args.modo == "cliente":
+        return modo_cliente(host=args.host, **endpoints)
+    if args.modo == "broker":
+        return modo_broker()
+    if args.modo == "federado":
+        return modo_servidor(args.broker, args.desplazamiento, metricas=args.metricas, **endpoints, **opciones)
+    if args.modo == "fragmentado":
+        return modo_servidor(fragmentos=args.fragmentos, metricas=args.metricas, **endpoints, **opciones)
+    if args.modo == "local":
+        return modo_local(**opciones)
+    
     print("\n" + "="*60)
     print("🚀 SISTEMA MULTI-CLIENTE CON PYZMQ Y THREADS")
     print("="*60)
     print("\nElige el modo:")
     print("  1) 🖥️  Servidor (ejecuta primero)")
     print("  2) 👤 Cliente (ejecuta en otra terminal)")
+    print("  3) 🛰️  Broker de federación (antes que los nodos)")
+    print("  4) 🌐 Servidor federado (nodo)")
+    print("  5) 🧩 Servidor multi-proceso (un fragmento de clientes por proceso)")
+    print("  6) 🏠 Servidor y cliente en este proceso (inproc)")
     print("="*60)
     
-    opcion = input("\nOpción (1 o 2): ").strip()
+    opcion = input("\nOpción (1-6): ").strip()
     
     if opcion == "1":
-        modo_servidor()
+        modo_servidor(metricas=args.metricas, **endpoints, **opciones)
     elif opcion == "2":
-        modo_cliente()
+        modo_cliente(host=args.host, **endpoints)
+    elif opcion == "3":
+        modo_broker()
+    elif opcion == "4":
+        broker = input("IP del broker [localhost]: ").strip() or "localhost"
+        desplazamiento = input("Desplazamiento de puertos [0]: ").strip()
+        modo_servidor(broker, int(desplazamiento or 0), metricas=args.metricas, **endpoints, **opciones)
+    elif opcion == "5":
+        fragmentos = input(f"Número de procesos [{NUM_FRAGMENTOS}]: ").strip()
+        modo_servidor(fragmentos=int(fragmentos or NUM_FRAGMENTOS), metricas=args.metricas,
+                      **endpoints, **opciones)
+    elif opcion == "6":
+        modo_local(**opciones)
     else:
         print("❌ Opción inválida")
 
@@ -12,6 +12,48 @@ import random
 SERVIDOR_PORT = "5555"
 CHAT_PORT = "5556"
 
+# Cola del chat: tamaño máximo y mensajes difundidos por pasada
+TAMANO_COLA_CHAT = 10000
+LOTE_BROADCAST = 1000
+
+class ColaChat(Queue):
+    """Cola acotada entre el Servidor y ChatBroadcast con política de desbordamiento"""
+    POLITICAS = ("descartar_antiguo", "descartar_nuevo", "bloquear")
+
+    def __init__(self, maxsize=TAMANO_COLA_CHAT, politica="descartar_antiguo"):
+        if politica not in self.POLITICAS:
+            raise ValueError(f"Politica de desbordamiento desconocida: {politica}")
+        Queue.__init__(self, maxsize)
+        self.politica = politica
+        self.descartados = 0
+
+    def put(self, item, block=True, timeout=None):
+        """Encola un mensaje; si la cola está llena aplica la política configurada"""
+        if self.politica == "bloquear":
+            return Queue.put(self, item, block, timeout)
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                self.descartados += 1
+                if self.politica == "descartar_nuevo":
+                    return
+                self._get()  # descartar_antiguo: se reemplaza el más viejo
+            else:
+                self.unfinished_tasks += 1
+            self._put(item)
+            self.not_empty.notify()
+
+    def drenar(self, maximo=LOTE_BROADCAST, timeout=None):
+        """Espera al primer mensaje y devuelve todos los pendientes (hasta maximo)"""
+        with self.not_empty:
+            if not self._qsize():
+                self.not_empty.wait(timeout)
+            lote = []
+            while self._qsize() and len(lote) < maximo:
+                lote.append(self._get())
+            if lote:
+                self.not_full.notify(len(lote))
+            return lote
+
 class Servidor(threading.Thread):
     """Servidor que maneja múltiples clientes simultáneamente"""
     def __init__(self, cola_chat):
@@ -26,6 +68,7 @@ class Servidor(threading.Thread):
     def run(self):
         context = zmq.Context()
         socket = context.socket(zmq.ROUTER)  # ROUTER maneja múltiples clientes
+        socket.setsockopt(zmq.ROUTER_HANDOVER, 1)  # Una identidad que reconecta reemplaza a la anterior
         socket.bind(f"tcp://*:{SERVIDOR_PORT}")
         socket.setsockopt(zmq.RCVTIMEO, 1000)
         
@@ -141,11 +184,13 @@ class ChatBroadcast(threading.Thread):
         time.sleep(0.5)
         
         while self.activo:
-            if not self.cola_chat.empty():
-                mensaje = self.cola_chat.get()
+            # Despierta en cuanto llega un mensaje y difunde todo lo pendiente
+            lote = self.cola_chat.drenar(LOTE_BROADCAST, timeout=1.0)
+            if not lote:
+                continue
+            for mensaje in lote:
                 socket.send_string(f"CHAT:{mensaje}")
-                print(f"[BROADCAST] {mensaje}")
-            time.sleep(0.1)
+            print("\n".join(f"[BROADCAST] {mensaje}" for mensaje in lote))
         
         socket.close()
         context.term()
@@ -184,31 +229,73 @@ class ClienteReceptor(threading.Thread):
     def detener(self):
         self.activo = False
 
+class SesionCliente:
+    """Conexion DEALER persistente con el servidor (un Context y un socket por sesion)"""
+    def __init__(self, identidad, endpoint, timeout=5000):
+        self.identidad = identidad
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.context = zmq.Context()
+        self.lock = threading.Lock()
+        self.socket = None
+        self._conectar()
+
+    def _conectar(self):
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.IDENTITY, self.identidad)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVTIMEO, self.timeout)
+        self.socket.connect(self.endpoint)
+
+    def enviar_comando(self, comando):
+        """Envía un comando y devuelve la respuesta (lanza zmq.Again si no hay respuesta)"""
+        with self.lock:
+            try:
+                self.socket.send_multipart([b"", comando.encode()])
+                _, respuesta = self.socket.recv_multipart()
+                return respuesta.decode()
+            except zmq.Again:
+                # La respuesta puede llegar tarde: se cambia de socket para no confundirla
+                # con la del siguiente comando (ZMQ reconecta solo por debajo)
+                self.socket.close()
+                self._conectar()
+                raise
+
+    def cerrar(self):
+        with self.lock:
+            self.socket.close()
+            self.context.term()
+
+# Sesiones reutilizadas por enviar_comando_cliente: (identidad, servidor) -> SesionCliente
+_sesiones = {}
+_sesiones_lock = threading.Lock()
+
+def obtener_sesion(identidad_cliente, ip_servidor):
+    """Devuelve la sesion persistente de esa identidad/servidor (la crea si no existe)"""
+    clave = (identidad_cliente, ip_servidor)
+    with _sesiones_lock:
+        sesion = _sesiones.get(clave)
+        if sesion is None:
+            endpoint = f"tcp://{ip_servidor}:{SERVIDOR_PORT}"
+            sesion = _sesiones[clave] = SesionCliente(identidad_cliente, endpoint)
+        return sesion
+
+def cerrar_sesiones():
+    """Cierra todas las sesiones abiertas por enviar_comando_cliente"""
+    with _sesiones_lock:
+        for sesion in _sesiones.values():
+            sesion.cerrar()
+        _sesiones.clear()
+
 def enviar_comando_cliente(comando, identidad_cliente, ip_servidor):
-    """Envía un comando al servidor usando DEALER (múltiples requests)"""
-    context = zmq.Context()
-    socket = context.socket(zmq.DEALER)
-    socket.setsockopt(zmq.IDENTITY, identidad_cliente)
-    socket.connect(f"tcp://{ip_servidor}:{SERVIDOR_PORT}")
-    socket.setsockopt(zmq.RCVTIMEO, 5000)
-    
+    """Envía un comando al servidor reutilizando la sesion DEALER de esa identidad"""
     try:
-        # Enviar comando
-        socket.send(b"", zmq.SNDMORE)
-        socket.send_string(comando)
-        
-        # Recibir respuesta
-        socket.recv()  # frame vacío
-        respuesta = socket.recv_string()
+        respuesta = obtener_sesion(identidad_cliente, ip_servidor).enviar_comando(comando)
         print(f"\n{respuesta}")
-        
     except zmq.Again:
         print("\n[TIMEOUT] El servidor no respondio a tiempo")
     except Exception as e:
         print(f"\n[ERROR] {e}")
-    finally:
-        socket.close()
-        context.term()
 
 def mostrar_menu():
     """Muestra el menú de comandos"""
@@ -243,7 +330,7 @@ def modo_servidor():
         print("[ADVERTENCIA] No se pudo determinar la IP automaticamente")
         print("[INFO] Usa 'ipconfig' (Windows) o 'ifconfig' (Linux/Mac)\n")
     
-    cola_chat = Queue()
+    cola_chat = ColaChat()
     
     servidor = Servidor(cola_chat)
     chat_broadcast = ChatBroadcast(cola_chat)
@@ -314,6 +401,7 @@ def modo_cliente():
         print("\n\n[INTERRUPT] Interrupcion detectada")
     finally:
         receptor.detener()
+        cerrar_sesiones()
         time.sleep(0.5)
         print("[OK] Cliente desconectado\n")
 
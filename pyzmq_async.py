@@ -0,0 +1,367 @@
+import zmq
+import zmq.asyncio
+import asyncio
+import itertools
+import random
+import struct
+from collections import deque
+
+from pyzmq import (
+    SERVIDOR_PORT,
+    CHAT_PORT,
+    TAMANO_COLA_CHAT,
+    LOTE_BROADCAST,
+    PREFIJO_CONFIRMACION,
+    PREFIJO_TRAZA,
+    ProcesadorComandos,
+    configurar_hwm,
+    desempaquetar_lote,
+    endpoint_bind,
+    endpoint_conexion,
+    leer_argumentos,
+    mostrar_menu,
+    tema_sala,
+)
+
+# Versión asyncio del sistema: servidor, difusión y receptor comparten un único
+# event loop y un único zmq.asyncio.Context, sin threads ni RCVTIMEO.
+
+class ColaChatAsync:
+    """Equivalente de ColaChat para un event loop: put() síncrono y drenar() awaitable"""
+    POLITICAS = ("descartar_antiguo", "descartar_nuevo")
+
+    def __init__(self, maxsize=TAMANO_COLA_CHAT, politica="descartar_antiguo"):
+        if politica not in self.POLITICAS:
+            raise ValueError(f"Política de desbordamiento desconocida: {politica}")
+        self.maxsize = maxsize
+        self.politica = politica
+        self.descartados = 0
+        self.mensajes = deque()
+        self.hay_mensajes = asyncio.Event()
+
+    def put(self, item):
+        """Encola sin bloquear el loop; si la cola está llena aplica la política"""
+        if 0 < self.maxsize <= len(self.mensajes):
+            self.descartados += 1
+            if self.politica == "descartar_nuevo":
+                return
+            self.mensajes.popleft()
+        self.mensajes.append(item)
+        self.hay_mensajes.set()
+
+    def qsize(self):
+        return len(self.mensajes)
+
+    async def drenar(self, maximo=LOTE_BROADCAST):
+        """Espera al primer mensaje y devuelve todos los pendientes (hasta maximo)"""
+        await self.hay_mensajes.wait()
+        lote = [self.mensajes.popleft() for _ in range(min(maximo, len(self.mensajes)))]
+        if not self.mensajes:
+            self.hay_mensajes.clear()
+        return lote
+
+class TareaAsync:
+    """Base de los componentes asyncio: run() corre como tarea y detener() la cancela
+
+    run() activa `listo` en cuanto tiene sus sockets abiertos. Como
+    threading.Thread con target, sin subclase run() espera la corrutina
+    `objetivo()` (si la hay).
+    """
+    def __init__(self, objetivo=None):
+        self.tarea = None
+        self.listo = asyncio.Event()
+        self.objetivo = objetivo
+
+    def iniciar(self):
+        self.tarea = asyncio.ensure_future(self.run())
+        return self.tarea
+
+    async def run(self):
+        self.listo.set()
+        if self.objetivo is not None:
+            await self.objetivo()
+
+    def detener(self):
+        if self.tarea is not None:
+            self.tarea.cancel()
+
+class ServidorAsync(ProcesadorComandos, TareaAsync):
+    """Servidor ROUTER sobre zmq.asyncio (mismos comandos que Servidor)"""
+    def __init__(self, context, cola_chat, puerto=SERVIDOR_PORT):
+        ProcesadorComandos.__init__(self, cola_chat)
+        TareaAsync.__init__(self)
+        self.context = context
+        self.puerto = puerto
+
+    async def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.ROUTER))
+        socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        socket.bind(endpoint_bind(self.puerto))
+
+        print("🟢 [SERVIDOR] Listo para múltiples clientes (asyncio)\n")
+        self.listo.set()
+
+        try:
+            while True:
+                try:
+                    respuesta = self.atender(await socket.recv_multipart())
+                    if respuesta:
+                        await socket.send_multipart(respuesta)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"❌ [SERVIDOR] Error: {e}")
+        finally:
+            socket.close(linger=0)
+
+class ChatBroadcastAsync(TareaAsync):
+    """Difunde los mensajes de ColaChatAsync en cuanto llegan
+
+    Como en ChatBroadcast, los mensajes son texto (chat general) o tuplas
+    (sala, texto) que salen con el tema de esa sala. Con historial, cada mensaje
+    se guarda en él y sale como [tema + texto, secuencia] para /historial y la
+    detección de huecos. Contesta las suscripciones de confirmación
+    (PREFIJO_CONFIRMACION) desde una segunda corrutina.
+    """
+    def __init__(self, context, cola_chat, puerto=CHAT_PORT, historial=None):
+        TareaAsync.__init__(self)
+        self.context = context
+        self.cola_chat = cola_chat
+        self.puerto = puerto
+        self.historial = historial
+
+    async def run(self):
+        socket = configurar_hwm(self.context.socket(zmq.XPUB))
+        socket.bind(endpoint_bind(self.puerto))
+
+        print("📻 [CHAT] Canal de difusión activo (asyncio)\n")
+        self.listo.set()
+
+        confirmaciones = asyncio.ensure_future(self._confirmar(socket))
+        try:
+            while True:
+                lote = await self.cola_chat.drenar(LOTE_BROADCAST)
+                lineas = []
+                for mensaje in lote:
+                    if isinstance(mensaje, tuple):
+                        sala, mensaje = mensaje[0], mensaje[1]
+                        lineas.append(f"📢 [#{sala}] {mensaje}" if sala else f"📢 {mensaje}")
+                    else:
+                        sala = None
+                        lineas.append(f"📢 {mensaje}")
+                    tema = tema_sala(sala)
+                    if self.historial is None:
+                        await socket.send_string(f"{tema}{mensaje}")
+                    else:
+                        seq = self.historial.agregar(tema, mensaje)
+                        await socket.send_multipart([f"{tema}{mensaje}".encode(), str(seq).encode()])
+                print("\n".join(lineas))
+        finally:
+            confirmaciones.cancel()
+            try:
+                await asyncio.gather(confirmaciones, return_exceptions=True)
+            finally:
+                # Aunque vuelvan a cancelar la tarea aquí: un socket abierto bloquea context.term()
+                socket.close(linger=0)
+
+    async def _confirmar(self, socket):
+        prefijo = b"\x01" + PREFIJO_CONFIRMACION.encode()
+        while True:
+            aviso = await socket.recv()
+            if aviso.startswith(prefijo):
+                await socket.send(aviso[1:])
+
+class ClienteReceptorAsync(TareaAsync):
+    """Escucha el chat general o el de la sala actual, sin thread propio ni timeout de recepción"""
+    def __init__(self, context, endpoint=f"tcp://localhost:{CHAT_PORT}"):
+        TareaAsync.__init__(self)
+        self.context = context
+        self.endpoint = endpoint
+        self.tema = tema_sala(None)
+        self.socket = None
+
+    def cambiar_sala(self, sala):
+        """Cambia la suscripción (mismo loop que run(), no hace falta pasar por inproc)"""
+        tema = tema_sala(sala)
+        if self.socket is not None:
+            self.socket.setsockopt_string(zmq.UNSUBSCRIBE, self.tema)
+            self.socket.setsockopt_string(zmq.SUBSCRIBE, tema)
+        self.tema = tema
+
+    async def run(self):
+        socket = self.socket = configurar_hwm(self.context.socket(zmq.SUB))
+        socket.connect(self.endpoint)
+        socket.setsockopt_string(zmq.SUBSCRIBE, self.tema)
+
+        try:
+            while True:
+                # [tema + texto, (secuencia)] o lote [tema, secuencia, textos]:
+                # aquí solo interesa el texto
+                frames = await socket.recv_multipart()
+                if len(frames) > 2 and frames[-1].startswith(PREFIJO_TRAZA.encode()):
+                    frames.pop()  # Anuncio trazado: sin identidad no hay a quién informar
+                if len(frames) == 3:
+                    mensajes = desempaquetar_lote(frames[2])
+                else:
+                    texto = frames[0].decode()
+                    if not texto.startswith(self.tema):
+                        continue  # Del tema anterior, llegó antes de cambiar de sala
+                    mensajes = [texto[len(self.tema):]]
+                print("\n" + "\n".join(mensajes))
+                print("💻 Comando: ", end="", flush=True)
+        finally:
+            socket.close(linger=0)
+
+async def servidor_async(listo=None, servidor=SERVIDOR_PORT, chat=CHAT_PORT):
+    """Ejecuta el servidor asyncio hasta que se cancele
+
+    Si se indica, listo.set() se llama con los sockets ya abiertos. servidor y
+    chat son puertos TCP o endpoints completos (ipc://...).
+    """
+    context = zmq.asyncio.Context()
+    cola_chat = ColaChatAsync()
+    servidor = ServidorAsync(context, cola_chat, servidor)
+    chat_broadcast = ChatBroadcastAsync(context, cola_chat, chat, servidor.historial)
+
+    tareas = [servidor.iniciar(), chat_broadcast.iniciar()]
+    try:
+        if listo is not None:
+            # Si una tarea falla antes (p. ej. puerto ocupado) no se espera más
+            sockets_abiertos = asyncio.gather(servidor.listo.wait(), chat_broadcast.listo.wait())
+            await asyncio.wait([sockets_abiertos, *tareas], return_when=asyncio.FIRST_COMPLETED)
+            sockets_abiertos.cancel()
+            listo.set()
+        await asyncio.gather(*tareas)
+    finally:
+        # Cancelar las tareas cierra los sockets al instante, sin esperar timeouts
+        servidor.detener()
+        chat_broadcast.detener()
+        await asyncio.gather(*tareas, return_exceptions=True)
+        context.term()
+
+async def cliente_async(identidad, servidor=f"tcp://localhost:{SERVIDOR_PORT}",
+                        chat=f"tcp://localhost:{CHAT_PORT}"):
+    """Cliente asyncio: DEALER y SUB en el mismo loop; input() en el executor
+
+    Cada comando lleva un id de correlación que el servidor devuelve: la
+    respuesta tardía de un comando que caducó se descarta y no se toma por la
+    del siguiente.
+    """
+    loop = asyncio.get_running_loop()
+    context = zmq.asyncio.Context()
+    socket = configurar_hwm(context.socket(zmq.DEALER))
+    socket.setsockopt(zmq.IDENTITY, identidad)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(servidor)
+
+    receptor = ClienteReceptorAsync(context, chat)
+    tarea_receptor = receptor.iniciar()
+    mostrar_menu()
+    ids = itertools.count(1)
+
+    async def enviar(comando):
+        id_peticion = struct.pack("!Q", next(ids))
+        await socket.send_multipart([b"", id_peticion, comando.encode()])
+        limite = loop.time() + 5
+        try:
+            while True:
+                frames = await asyncio.wait_for(socket.recv_multipart(), limite - loop.time())
+                # [vacío, id_peticion, respuesta]; las de comandos ya caducados se ignoran
+                if len(frames) == 3 and frames[1] == id_peticion:
+                    break
+        except asyncio.TimeoutError:
+            print("\n⏱️ Timeout: El servidor no respondió")
+            return
+        respuesta = frames[2].decode()
+        print(f"\n{respuesta}")
+
+        # Al cambiar de sala, el receptor cambia su suscripción
+        if respuesta.startswith("✅"):
+            verbo, _, sala = comando.partition(" ")
+            if verbo == "/join":
+                receptor.cambiar_sala(sala.strip())
+            elif verbo in ("/leave", "/logout"):
+                receptor.cambiar_sala(None)
+
+    try:
+        while True:
+            comando = (await loop.run_in_executor(None, input, "💻 Comando: ")).strip()
+
+            if not comando:
+                continue
+
+            if comando == "/salir":
+                await enviar("/logout")
+                print("\n👋 Cerrando cliente...")
+                break
+
+            if comando == "/ayuda":
+                mostrar_menu()
+                continue
+
+            await enviar(comando)
+    finally:
+        receptor.detener()
+        await asyncio.gather(tarea_receptor, return_exceptions=True)
+        socket.close()
+        context.term()
+
+def modo_servidor_async(servidor=SERVIDOR_PORT, chat=CHAT_PORT):
+    """Ejecuta el servidor asyncio"""
+    print("\n" + "="*60)
+    print("🖥️  MODO SERVIDOR (asyncio) - Sistema Multi-Cliente")
+    print("="*60 + "\n")
+    print("   Presiona Ctrl+C para detener\n")
+
+    try:
+        asyncio.run(servidor_async(servidor=servidor, chat=chat))
+    except KeyboardInterrupt:
+        pass
+    print("\n✅ Servidor detenido\n")
+
+def modo_cliente_async(servidor=SERVIDOR_PORT, chat=CHAT_PORT, host="localhost"):
+    """Ejecuta un cliente asyncio"""
+    identidad = f"cliente-{random.randint(1000, 9999)}".encode()
+
+    print("\n" + "="*60)
+    print(f"👤 MODO CLIENTE (asyncio) - ID: {identidad.decode()}")
+    print("="*60 + "\n")
+    print("💡 Primero usa /login <tu_nombre> para identificarte\n")
+
+    try:
+        asyncio.run(cliente_async(identidad, endpoint_conexion(servidor, host),
+                                  endpoint_conexion(chat, host)))
+    except KeyboardInterrupt:
+        print("\n\n⚠️ Interrupción detectada")
+    print("✅ Cliente desconectado\n")
+
+def main():
+    # Mismos flags y variables PYZMQ_* que pyzmq.py; aquí solo hay servidor y cliente
+    args = leer_argumentos()
+    if args.modo == "servidor":
+        return modo_servidor_async(args.servidor, args.chat)
+    if args.modo == "cliente":
+        return modo_cliente_async(args.servidor, args.chat, args.host)
+    if args.modo:
+        print(f"❌ El modo {args.modo} no existe en la versión asyncio")
+        return
+
+    print("\n" + "="*60)
+    print("🚀 SISTEMA MULTI-CLIENTE CON PYZMQ Y ASYNCIO")
+    print("="*60)
+    print("\nElige el modo:")
+    print("  1) 🖥️  Servidor (ejecuta primero)")
+    print("  2) 👤 Cliente (ejecuta en otra terminal)")
+    print("="*60)
+
+    opcion = input("\nOpción (1 o 2): ").strip()
+
+    if opcion == "1":
+        modo_servidor_async(args.servidor, args.chat)
+    elif opcion == "2":
+        modo_cliente_async(args.servidor, args.chat, args.host)
+    else:
+        print("❌ Opción inválida")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import collections
+
+import pytest
+
+from pyzmq import AnilloHash
+
+
+def reparto(num_nodos, claves):
+    nodos = [b"fragmento-%d" % i for i in range(num_nodos)]
+    anillo = AnilloHash(nodos)
+    cuenta = collections.Counter(anillo.nodo(clave) for clave in claves)
+    return [cuenta[nodo] for nodo in nodos]
+
+
+@pytest.mark.parametrize("num_nodos", [2, 4, 8])
+def test_reparto_equilibrado(num_nodos):
+    # Identidades parecidas, como las de benchmark.py (bench-<proceso>-<cliente>)
+    claves = [b"bench-%d-%d" % (j, k) for j in range(40) for k in range(500)]
+    justo = len(claves) / num_nodos
+    for cantidad in reparto(num_nodos, claves):
+        assert abs(cantidad - justo) < 0.15 * justo
+
+
+def test_identidades_consecutivas_no_se_amontonan():
+    assert max(reparto(4, [b"id-%d" % i for i in range(1000)])) < 0.35 * 1000
+
+
+def test_misma_identidad_mismo_nodo():
+    anillo = AnilloHash([b"a", b"b", b"c"])
+    assert all(anillo.nodo(b"cliente-7") == anillo.nodo(b"cliente-7") for _ in range(10))